@@ -1,11 +1,23 @@
-
-from os.path import join, exists
+import os
+import re
+from os.path import join, exists, getsize
 from hashlib import sha256
+from threading import Lock
+from time import time
 
 from .persistence import PersistenceStore
 from .util import atomicish_move
 from .util import Time
 
+from logging import getLogger
+log = getLogger(__name__)
+
+FILE_PREFIX = "file:"
+USED_PREFIX = "used:"
+STAGED_SUFFIX = ".staged"
+DIGEST_BLOCK_SIZE = 1024 * 1024
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
 
 class CacheFileMapper(object):
 
@@ -19,47 +31,222 @@ class CacheFileMapper(object):
 class Cache(PersistenceStore):
     """
     Maintain a cache of uploaded files.
+
+    Files are requested by (ip, path) tokens. By default a token is also the
+    name of the cached file. With ``content_addressed`` files are stored
+    under the sha256 digest of their contents (given by the client or
+    computed on insert) and tokens become aliases of that digest, so the same
+    file staged from several hosts or paths is stored once.
+
+    With ``max_bytes`` the least recently used files are evicted whenever
+    the cached files add up to more than that many bytes. Files are only
+    evicted, resolved and opened under the lock, so a file reported ready
+    can still be opened.
     """
 
-    def __init__(self, cache_directory="file_cache"):
+    def __init__(self, cache_directory="file_cache", content_addressed=False, max_bytes=None):
         super(Cache, self).__init__(join(cache_directory, "cache_shelf"))
         self.file_mapper = CacheFileMapper(cache_directory)
         self.time = Time
-
-    def cache_required(self, ip, path):
+        self.content_addressed = content_addressed
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__stats_lock = Lock()
+        self.total_bytes = self._with_lock(self.__stored_bytes) or 0
+
+    def cache_required(self, ip, path, digest=None):
         token = self.__token(ip, path)
-
-        def get_token():
+        digest = _check_digest(digest)
+
+        def alias_cached():
+            # Someone else may already have cached these contents
+            if not exists(self.destination(digest)):
+                return False
+            self.__set_alias(token, digest)
+            return True
+        if self.content_addressed and digest and self._with_lock(alias_cached, suppress_exception=False):
             inserted = False
-            if token not in self.shelf:
-                self.shelf[token] = self.time.now()
-                inserted = True
-            return inserted
+        else:
+            inserted = self.shelf.add(token, {"inserted": self.time.now(), "key": None})
+        self.__count("misses" if inserted else "hits")
+        return inserted
 
-        return self._with_lock(get_token)
-
-    def cache_file(self, local_path, ip, path):
+    def cache_file(self, local_path, ip, path, digest=None):
         """
         Move a file from a temporary staging area into the cache.
         """
-        destination = self.__destination(ip, path)
-        atomicish_move(local_path, destination)
-
-    def file_available(self, ip, path):
         token = self.__token(ip, path)
-        ready = exists(self.destination(token))
-        return {"token": token, "ready": ready}
+        digest = _check_digest(digest)
+        if self.content_addressed:
+            key = file_digest(local_path)
+            if digest and digest != key:
+                log.warn("Cached file %s has digest %s, not %s as given by the client" % (path, key, digest))
+        else:
+            key = token
+        destination = self.destination(key)
+        # Moved next to the cached files first, the lock is only held for a rename
+        staged = self.destination(token) + STAGED_SUFFIX
+        atomicish_move(local_path, staged)
+
+        def record():
+            if self.content_addressed and exists(destination):
+                os.remove(staged)
+            else:
+                os.rename(staged, destination)
+            self.__record_file(key, getsize(destination))
+            self.__set_alias(token, key)
+            self.__evict(keep=key)
+        self._with_lock(record)
+
+    def file_available(self, ip, path, digest=None):
+        token = self.__token(ip, path)
+        digest = _check_digest(digest)
+        key = self.__key(token)
+        if self.max_bytes is None:
+            # Nothing is evicted, known and missing files need no lock
+            if key is None and not (self.content_addressed and digest):
+                return {"token": token, "ready": False}
+            if key is not None and FILE_PREFIX + key in self.shelf:
+                if not exists(self.destination(key)):
+                    return {"token": token, "ready": False}
+                self.shelf[USED_PREFIX + key] = time()
+                return {"token": key, "ready": True}
+        return self._with_lock(lambda: self.__available(token, digest), suppress_exception=False)
+
+    def open_file(self, token):
+        """ Open a cached file for reading, it stays readable once open even
+        if it is evicted afterwards.
+        """
+        return self._with_lock(lambda: open(self.destination(token), "rb"), suppress_exception=False)
 
     def destination(self, token):
         return self.file_mapper.get(token)
 
-    def __destination(self, ip, path):
-        token = self.__token(ip, path)
-        return self.destination(token)
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    def __count(self, counter):
+        with self.__stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def __key(self, token):
+        """ Name of the cached file of a token, None while it is not cached.
+        """
+        entry = self.shelf.get(token, None)
+        if entry is None:
+            return None
+        if not isinstance(entry, dict):
+            # Entries written before files were tracked only hold the
+            # insertion time and are stored under the token.
+            return token
+        return entry["key"]
+
+    def __available(self, token, digest):
+        key = self.__key(token)
+        if key is None and self.content_addressed and digest and exists(self.destination(digest)):
+            key = digest
+        if key is None or not exists(self.destination(key)):
+            return {"token": token, "ready": False}
+        # Also records files cached before sizes and aliases were tracked
+        self.__set_alias(token, key)
+        self.shelf[USED_PREFIX + key] = time()
+        return {"token": key, "ready": True}
+
+    def __set_alias(self, token, key):
+        """ Point token at a cached file and add it to the aliases of the
+        file, which are the tokens dropped when it is evicted.
+        """
+        entry = self.shelf.get(token, None)
+        if not isinstance(entry, dict) or entry["key"] != key:
+            inserted = entry["inserted"] if isinstance(entry, dict) else self.time.now()
+            self.shelf[token] = {"inserted": inserted, "key": key}
+        file_entry = self.shelf.get(FILE_PREFIX + key, None)
+        if file_entry is None:
+            if not exists(self.destination(key)):
+                return
+            file_entry = self.__record_file(key, getsize(self.destination(key)))
+        if token not in file_entry["aliases"]:
+            file_entry["aliases"].append(token)
+            self.shelf[FILE_PREFIX + key] = file_entry
+
+    def __record_file(self, key, size):
+        file_entry = self.shelf.get(FILE_PREFIX + key, None)
+        if file_entry is None:
+            file_entry = {"size": size, "aliases": []}
+        else:
+            self.total_bytes -= file_entry["size"]
+            file_entry["size"] = size
+        self.shelf[FILE_PREFIX + key] = file_entry
+        self.shelf[USED_PREFIX + key] = time()
+        self.total_bytes += size
+        return file_entry
+
+    def __evict(self, keep=None):
+        if self.max_bytes is None or self.total_bytes <= self.max_bytes:
+            return
+        last_used = dict((used_key[len(USED_PREFIX):], used) for used_key, used in self.shelf.items(USED_PREFIX))
+        files = []
+        for file_key, entry in self.shelf.items(FILE_PREFIX):
+            key = file_key[len(FILE_PREFIX):]
+            files.append((last_used.get(key, 0), key, entry))
+        for used, key, entry in sorted(files, key=lambda f: f[0]):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            log.info("Evicting cached file %s (%d bytes)" % (key, entry["size"]))
+            try:
+                os.remove(self.destination(key))
+            except OSError:
+                pass
+            for token in entry["aliases"]:
+                if token in self.shelf:
+                    del self.shelf[token]
+            del self.shelf[FILE_PREFIX + key]
+            if USED_PREFIX + key in self.shelf:
+                del self.shelf[USED_PREFIX + key]
+            self.total_bytes -= entry["size"]
+            self.__count("evictions")
+
+    def __stored_bytes(self):
+        return sum(entry["size"] for file_key, entry in self.shelf.items(FILE_PREFIX))
 
     def __token(self, ip, path):
         for_hash = "IP:%s:%s" % (ip, path)
         return sha256(for_hash.encode('UTF-8')).hexdigest()
 
 
+def file_digest(path):
+    """ sha256 of the contents of a file, read in blocks.
+    """
+    digest = sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(DIGEST_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _check_digest(digest):
+    """ Client supplied digests name files in the cache directory, only
+    accept lowercase hex sha256 digests.
+    """
+    if not digest:
+        return None
+    digest = str(digest).lower()
+    if not DIGEST_PATTERN.match(digest):
+        raise ValueError("Invalid sha256 digest %s" % digest)
+    return digest
+
+
 __all__ = [Cache]
@@ -1,9 +1,148 @@
+import os
 import shelve
-from threading import Lock
+import sqlite3
+from contextlib import contextmanager
+from threading import Lock, local
 import traceback
 
+from six.moves import cPickle as pickle
+try:
+    from whichdb import whichdb
+except ImportError:
+    from dbm import whichdb
+
+from logging import getLogger
+log = getLogger(__name__)
+
+SQLITE_SUFFIX = ".sqlite"
+# Readable by both Python 2 and 3
+PICKLE_PROTOCOL = 2
+# Files a shelf may consist of depending on the dbm module that wrote it.
+SHELF_SUFFIXES = ["", ".db", ".dat", ".dir", ".bak", ".pag"]
+
+
+class SqliteShelf(object):
+    """
+    Dictionary like store of picklable values in an SQLite database in WAL
+    mode.
+
+    Every thread gets its own connection. Outside of ``transaction()`` each
+    assignment is a single autocommitted upsert, and readers see the last
+    committed state without waiting for writers.
+    """
+
+    def __init__(self, filename, synchronous=True):
+        self.filename = filename
+        self.synchronous = synchronous
+        self.__local = local()
+        self.__connections = []
+        self.__connections_lock = Lock()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value BLOB NOT NULL)"
+        )
+
+    def _connection(self):
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.filename, timeout=60, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=%s" % ("FULL" if self.synchronous else "NORMAL"))
+            connection.text_factory = str
+            self.__local.connection = connection
+            with self.__connections_lock:
+                self.__connections.append(connection)
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """ Group writes, committed together when the outermost block ends.
+        """
+        connection = self._connection()
+        depth = getattr(self.__local, "depth", 0)
+        self.__local.depth = depth + 1
+        if depth == 0:
+            connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            # Also roll back when interrupted, an open transaction would keep the database locked
+            if depth == 0:
+                connection.execute("ROLLBACK")
+            raise
+        else:
+            if depth == 0:
+                connection.execute("COMMIT")
+        finally:
+            self.__local.depth = depth
+
+    def __getitem__(self, key):
+        row = self._connection().execute("SELECT value FROM store WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return _loads(row[0])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO store (key, value) VALUES (?, ?)", (key, _dumps(value))
+        )
+
+    def add(self, key, value):
+        """ Store value only if key is absent, returns whether it was stored.
+        """
+        cursor = self._connection().execute(
+            "INSERT OR IGNORE INTO store (key, value) VALUES (?, ?)", (key, _dumps(value))
+        )
+        return cursor.rowcount == 1
+
+    def __delitem__(self, key):
+        cursor = self._connection().execute("DELETE FROM store WHERE key = ?", (key,))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self._connection().execute("SELECT 1 FROM store WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM store").fetchone()[0]
+
+    def keys(self, prefix=""):
+        rows = self._connection().execute(
+            "SELECT key FROM store WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def items(self, prefix=""):
+        rows = self._connection().execute(
+            "SELECT key, value FROM store WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+        ).fetchall()
+        return [(key, _loads(value)) for key, value in rows]
+
+    def sync(self):
+        """ Writes are committed as they happen, nothing to do.
+        """
+
+    def close(self):
+        with self.__connections_lock:
+            for connection in self.__connections:
+                connection.close()
+            self.__connections = []
+        self.__local = local()
+
 
 class PersistenceStore(object):
+    """
+    Base for objects persisting state in ``self.shelf``.
+
+    Groups of reads and writes that must not interleave with other threads
+    go through ``_with_lock``, which also commits them as one transaction.
+    Single reads and single writes can use ``self.shelf`` directly.
+    """
 
     def __init__(self, filename, require_sync=True):
         self.shelf_filename = filename
@@ -12,7 +151,11 @@ class PersistenceStore(object):
         self.__shelf_lock = Lock()
 
     def __open_shelf(self):
-        self.shelf = shelve.open(self.shelf_filename, writeback=self.__require_sync) if self.shelf_filename else None
+        if not self.shelf_filename:
+            self.shelf = None
+            return
+        self.shelf = SqliteShelf(self.shelf_filename + SQLITE_SUFFIX, synchronous=self.__require_sync)
+        migrate_shelf(self.shelf_filename, self.shelf)
 
     def close(self):
         self.shelf.close()
@@ -28,8 +171,39 @@ class PersistenceStore(object):
         if self.shelf is not None:
             with self._lock():
                 try:
-                    return func()
+                    with self.shelf.transaction():
+                        return func()
                 except:
                     traceback.print_exc()
                     if not suppress_exception:
                         raise
+
+
+def migrate_shelf(shelf_filename, store):
+    """
+    Copy the entries of a shelf written by earlier versions into store and
+    rename its files so this only happens once. Entries already in store win.
+    """
+    if not whichdb(shelf_filename):
+        return
+    shelf = shelve.open(shelf_filename, flag="r")
+    try:
+        with store.transaction():
+            for key in shelf.keys():
+                store.add(key, shelf[key])
+        count = len(shelf)
+    finally:
+        shelf.close()
+    for suffix in SHELF_SUFFIXES:
+        path = shelf_filename + suffix
+        if os.path.isfile(path):
+            os.rename(path, path + ".migrated")
+    log.info("Migrated %d entries of %s to %s" % (count, shelf_filename, store.filename))
+
+
+def _dumps(value):
+    return sqlite3.Binary(pickle.dumps(value, PICKLE_PROTOCOL))
+
+
+def _loads(value):
+    return pickle.loads(bytes(value))
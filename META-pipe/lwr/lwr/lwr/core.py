@@ -11,6 +11,7 @@ from lwr import messaging
 from galaxy.objectstore import build_object_store_from_config
 from galaxy.tools.deps import DependencyManager
 from galaxy.jobs.metrics import JobMetrics
+from galaxy.util import asbool
 from galaxy.util.bunch import Bunch
 
 from logging import getLogger
@@ -92,7 +93,16 @@ class LwrApp(object):
 
     def __setup_file_cache(self, conf):
         file_cache_dir = conf.get('file_cache_dir', None)
-        self.file_cache = Cache(file_cache_dir) if file_cache_dir else None
+        if not file_cache_dir:
+            self.file_cache = None
+            return
+        content_addressed = asbool(conf.get('file_cache_content_addressed', False))
+        max_bytes = conf.get('file_cache_max_bytes', None)
+        self.file_cache = Cache(
+            file_cache_dir,
+            content_addressed=content_addressed,
+            max_bytes=int(max_bytes) if max_bytes else None,
+        )
 
     def __setup_object_store(self, conf):
         if "object_store_config_file" not in conf:
@@ -37,6 +37,32 @@ class ExternalBaseManager(DirectoryBaseManager):
             raise KeyError("Failed to find external id for job_id %s" % job_id)
         return self._get_status_external(external_id)
 
+    def get_statuses(self, job_ids):
+        """ Statuses of several jobs at once, as a dict keyed by job id.
+
+        Jobs whose status could not be determined this way are left out and
+        should be checked with get_status.
+        """
+        external_ids = {}
+        for job_id in job_ids:
+            external_id = self._external_id(job_id)
+            if external_id:
+                external_ids[job_id] = external_id
+        if not external_ids:
+            return {}
+        external_statuses = self._get_statuses_external(list(set(external_ids.values())))
+        statuses = {}
+        for job_id, external_id in external_ids.items():
+            if external_id in external_statuses:
+                statuses[job_id] = external_statuses[external_id]
+        return statuses
+
+    def _get_statuses_external(self, external_ids):
+        """ Override with a single query of the resource manager for the
+        statuses of many jobs, keyed by external id.
+        """
+        return {}
+
     def _get_job_id(self, input_job_id):
         return str(self.id_assigner(input_job_id))
 
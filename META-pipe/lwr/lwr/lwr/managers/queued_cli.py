@@ -59,3 +59,14 @@ class CliQueueManager(ExternalBaseManager):
         cmd_out = shell.execute(status_command)
         state = job_interface.parse_single_status(cmd_out.stdout, external_id)
         return state
+
+    def _get_statuses_external(self, external_ids):
+        shell, job_interface = self.__get_cli_plugins()
+        status_command = job_interface.get_status(external_ids)
+        cmd_out = shell.execute(status_command)
+        if cmd_out.returncode != 0:
+            log.warn("Failed to get job statuses - command was %s" % status_command)
+            return {}
+        # Jobs missing from the listing may have just finished, those are
+        # left to get_single_status as before.
+        return job_interface.parse_status(cmd_out.stdout, external_ids) or {}
@@ -1,8 +1,11 @@
 import datetime
+import heapq
 import os
 import time
 import threading
 
+from six.moves import queue
+
 from lwr.managers import ManagerProxy
 from lwr.managers import status
 from .staging import preprocess
@@ -22,6 +25,17 @@ JOB_FILE_PREPROCESSED = "preprocessed"
 JOB_METADATA_RUNNING = "running"
 
 DEFAULT_MIN_POLLING_INTERVAL = 0.5
+DEFAULT_MAX_POLLING_INTERVAL = 60
+DEFAULT_POLLING_BACKOFF = 2
+DEFAULT_MONITOR_THREADS = 4
+
+STOP_SIGNAL = object()
+
+JOURNAL_ACTIVATE = "+"
+JOURNAL_DEACTIVATE = "-"
+# Compact once the journal holds this many entries per active job (plus slack)
+JOURNAL_COMPACT_RATIO = 4
+JOURNAL_COMPACT_SLACK = 1000
 
 
 class StatefulManagerProxy(ManagerProxy):
@@ -30,8 +44,11 @@ class StatefulManagerProxy(ManagerProxy):
 
     def __init__(self, manager, **manager_options):
         super(StatefulManagerProxy, self).__init__(manager)
-        min_polling_interval = manager_options.get("min_polling_interval", DEFAULT_MIN_POLLING_INTERVAL)
-        self.min_polling_interval = datetime.timedelta(0, min_polling_interval)
+        self.min_polling_seconds = float(manager_options.get("min_polling_interval", DEFAULT_MIN_POLLING_INTERVAL))
+        self.min_polling_interval = datetime.timedelta(0, self.min_polling_seconds)
+        self.max_polling_seconds = max(float(manager_options.get("max_polling_interval", DEFAULT_MAX_POLLING_INTERVAL)), self.min_polling_seconds)
+        self.polling_backoff = max(float(manager_options.get("polling_backoff", DEFAULT_POLLING_BACKOFF)), 1.0)
+        self.monitor_threads = max(int(manager_options.get("monitor_threads", DEFAULT_MONITOR_THREADS)), 1)
         self.active_jobs = ActiveJobs(manager)
         self.__state_change_callback = lambda status, job_id: None
         self.__recover_active_jobs()
@@ -41,6 +58,13 @@ class StatefulManagerProxy(ManagerProxy):
         self.__state_change_callback = state_change_callback
         self.__monitor = ManagerMonitor(self)
 
+    def monitor_metrics(self):
+        """ Poll counts and lag of the job monitor, None without a monitor.
+        """
+        if self.__monitor is None:
+            return None
+        return self.__monitor.metrics()
+
     @property
     def name(self):
         return self._proxied_manager.name
@@ -70,13 +94,16 @@ class StatefulManagerProxy(ManagerProxy):
 
         new_thread_for_manager(self, "preprocess", do_preprocess, daemon=False)
 
-    def get_status(self, job_id):
+    def get_status(self, job_id, proxied_status=None):
         """ Compute status used proxied manager and handle state transitions
         and track additional state information needed.
+
+        proxied_status may be given when the proxied manager's status of the
+        job is already known, e.g. from get_proxied_statuses.
         """
         job_directory = self._proxied_manager.job_directory(job_id)
         with job_directory.lock("status"):
-            proxy_status, state_change = self.__proxy_status(job_directory, job_id)
+            proxy_status, state_change = self.__proxy_status(job_directory, job_id, proxied_status)
 
         if state_change == "to_complete":
             self.__deactivate(job_id, proxy_status)
@@ -85,7 +112,20 @@ class StatefulManagerProxy(ManagerProxy):
 
         return self.__status(job_directory, proxy_status)
 
-    def __proxy_status(self, job_directory, job_id):
+    def get_proxied_statuses(self, job_ids):
+        """ Statuses of the proxied manager for many jobs with one query, for
+        managers that support it. Jobs left out need their own query.
+        """
+        get_statuses = getattr(self._proxied_manager, "get_statuses", None)
+        if get_statuses is None or not job_ids:
+            return {}
+        try:
+            return get_statuses(job_ids)
+        except Exception:
+            log.exception("Failed to get statuses of active jobs of manager %s" % self.name)
+            return {}
+
+    def __proxy_status(self, job_directory, job_id, proxied_status=None):
         """ Determine state with proxied job manager and if this job needs
         to be marked as deactivated (this occurs when job first returns a
         complete status from proxy.
@@ -96,7 +136,9 @@ class StatefulManagerProxy(ManagerProxy):
         elif job_directory.has_metadata(JOB_FILE_FINAL_STATUS):
             proxy_status = job_directory.load_metadata(JOB_FILE_FINAL_STATUS)
         else:
-            proxy_status = self._proxied_manager.get_status(job_id)
+            if proxied_status is None:
+                proxied_status = self._proxied_manager.get_status(job_id)
+            proxy_status = proxied_status
             if proxy_status == status.RUNNING:
                 if not job_directory.has_metadata(JOB_METADATA_RUNNING):
                     job_directory.store_metadata(JOB_METADATA_RUNNING, True)
@@ -147,9 +189,13 @@ class StatefulManagerProxy(ManagerProxy):
                 self.__monitor.shutdown()
             except Exception:
                 log.exception("Failed to shutdown job monitor for manager %s" % self.name)
+        self.active_jobs.close()
         super(StatefulManagerProxy, self).shutdown()
 
     def __recover_active_jobs(self):
+        """ Hand the jobs left active in the journal replayed by ActiveJobs
+        back to the proxied manager.
+        """
         recover_method = getattr(self._proxied_manager, "_recover_active_job", None)
         if recover_method is None:
             return
@@ -163,63 +209,157 @@ class StatefulManagerProxy(ManagerProxy):
 
 class ActiveJobs(object):
     """ Keeps track of active jobs (those that are not yet "complete").
-    Current implementation is file based, but could easily be made
-    database-based instead.
 
-    TODO: Keep active jobs in memory after initial load so don't need to repeatedly
-    hit disk to recover this information.
+    The active job ids are kept in memory and made durable through an append
+    only journal of activations and deactivations in the persistence
+    directory, replayed on startup and rewritten once it has grown to many
+    times the size of the active set.
     """
 
     def __init__(self, manager):
         persistence_directory = manager.persistence_directory
+        self.active_job_ids_set = set()
+        self.lock = threading.Lock()
+        self.journal_entries = 0
+        self.journal = None
         if persistence_directory:
-            active_job_directory = os.path.join(persistence_directory, "%s-active-jobs" % manager.name)
-            if not os.path.exists(active_job_directory):
-                os.makedirs(active_job_directory)
+            self.journal_path = os.path.join(persistence_directory, "%s-active-jobs.journal" % manager.name)
+            # Directory of one empty file per active job used by older versions
+            self.active_job_directory = os.path.join(persistence_directory, "%s-active-jobs" % manager.name)
+            self.__load()
         else:
-            active_job_directory = None
-        self.active_job_directory = active_job_directory
+            self.journal_path = None
+            self.active_job_directory = None
 
     def active_job_ids(self):
-        job_ids = []
-        if self.active_job_directory:
-            job_ids = os.listdir(self.active_job_directory)
-        return job_ids
+        with self.lock:
+            return list(self.active_job_ids_set)
 
     def activate_job(self, job_id):
-        if self.active_job_directory:
-            path = self._active_job_file(job_id)
+        with self.lock:
+            self.active_job_ids_set.add(job_id)
             try:
-                open(path, "w").close()
+                self.__append(JOURNAL_ACTIVATE, job_id)
             except Exception:
                 log.warn(ACTIVATE_FAILED_MESSAGE % job_id)
 
     def deactivate_job(self, job_id):
-        if self.active_job_directory:
-            path = self._active_job_file(job_id)
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                except Exception:
-                    log.warn(DECACTIVATE_FAILED_MESSAGE % job_id)
-
-    def _active_job_file(self, job_id):
-        return os.path.join(self.active_job_directory, job_id)
+        with self.lock:
+            if job_id not in self.active_job_ids_set:
+                return
+            self.active_job_ids_set.discard(job_id)
+            try:
+                self.__append(JOURNAL_DEACTIVATE, job_id)
+            except Exception:
+                log.warn(DECACTIVATE_FAILED_MESSAGE % job_id)
+
+    def compact(self):
+        with self.lock:
+            self.__compact()
+
+    def close(self):
+        with self.lock:
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+
+    def __load(self):
+        if not os.path.exists(self.journal_path) and os.path.isdir(self.active_job_directory):
+            # First start with a journal, it takes over from the directory
+            # which is left alone in case an older version is started again.
+            self.active_job_ids_set.update(os.listdir(self.active_job_directory))
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r") as journal:
+                for line in journal:
+                    if not line.endswith("\n"):
+                        # Torn write of the last entry before a crash
+                        break
+                    op, job_id = line[0], line[2:-1]
+                    if op == JOURNAL_ACTIVATE:
+                        self.active_job_ids_set.add(job_id)
+                    elif op == JOURNAL_DEACTIVATE:
+                        self.active_job_ids_set.discard(job_id)
+        self.__compact()
+
+    def __append(self, op, job_id):
+        if not self.journal_path:
+            return
+        if "\n" in job_id:
+            raise ValueError("Job id %r contains a newline" % job_id)
+        if self.journal is None:
+            self.journal = open(self.journal_path, "a")
+        self.journal.write("%s %s\n" % (op, job_id))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal_entries += 1
+        if self.journal_entries > JOURNAL_COMPACT_RATIO * len(self.active_job_ids_set) + JOURNAL_COMPACT_SLACK:
+            self.__compact()
+
+    def __compact(self):
+        """ Replace the journal with one activation per active job.
+        """
+        if not self.journal_path:
+            return
+        if self.journal:
+            self.journal.close()
+        temp_path = self.journal_path + ".tmp"
+        with open(temp_path, "w") as journal:
+            for job_id in self.active_job_ids_set:
+                journal.write("%s %s\n" % (JOURNAL_ACTIVATE, job_id))
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.rename(temp_path, self.journal_path)
+        self.journal = open(self.journal_path, "a")
+        self.journal_entries = len(self.active_job_ids_set)
 
 
 class ManagerMonitor(object):
     """ Monitors active jobs of a StatefulManagerProxy.
+
+    Every job has its own next check time, kept in a heap. While the status
+    of a job stays the same the time between its checks grows by
+    ``polling_backoff`` up to ``max_polling_interval``, and drops back to
+    ``min_polling_interval`` when the status changes. Checks are made by a
+    few worker threads so one slow get_status does not hold up the others.
     """
 
     def __init__(self, stateful_manager):
         self.stateful_manager = stateful_manager
         self.active = True
+        self.lock = threading.Lock()
+        self.schedule = []
+        self.polled_jobs = {}
+        self.polls = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.work_queue = queue.Queue()
+        self.work_threads = []
+        for i in range(stateful_manager.monitor_threads):
+            worker = new_thread_for_manager(self, "monitor-worker-%d" % i, self._work, True)
+            self.work_threads.append(worker)
         thread = new_thread_for_manager(self, "monitor", self._run, True)
         self.thread = thread
 
     def shutdown(self):
         self.active = False
         self.thread.join()
+        for worker in self.work_threads:
+            self.work_queue.put(STOP_SIGNAL)
+        for worker in self.work_threads:
+            worker.join()
+
+    def metrics(self):
+        """ Poll counts and lag (seconds between a job falling due and its
+        check starting) since the monitor started.
+        """
+        with self.lock:
+            return {
+                "active_jobs": len(self.polled_jobs),
+                "polls": self.polls,
+                "mean_lag": self.total_lag / self.polls if self.polls else 0.0,
+                "max_lag": self.max_lag,
+                "queued_checks": self.work_queue.qsize(),
+            }
 
     def _run(self):
         """ Main loop, repeatedly checking active jobs of stateful manager.
@@ -231,23 +371,97 @@ class ManagerMonitor(object):
                 log.exception("Failure in stateful manager monitor step.")
 
     def _monitor_active_jobs(self):
+        due_jobs = self._due_jobs(time.time())
+        if due_jobs:
+            # One query of the resource manager for all jobs where supported
+            proxied_statuses = self.stateful_manager.get_proxied_statuses([job.job_id for job in due_jobs])
+            for job in due_jobs:
+                self.work_queue.put((job, proxied_statuses.get(job.job_id, None)))
+        time.sleep(self._time_to_next_check(time.time()))
+
+    def _due_jobs(self, now):
+        """ Schedule newly active jobs, forget finished ones and take the jobs
+        due for a check off the schedule.
+        """
         active_job_ids = self.stateful_manager.active_jobs.active_job_ids()
-        iteration_start = datetime.datetime.now()
-        for active_job_id in active_job_ids:
+        with self.lock:
+            for job_id in active_job_ids:
+                if job_id not in self.polled_jobs:
+                    job = PolledJob(job_id, now, self.stateful_manager.min_polling_seconds)
+                    self.polled_jobs[job_id] = job
+                    heapq.heappush(self.schedule, (job.next_check, job_id))
+            if len(self.polled_jobs) > len(active_job_ids):
+                active = set(active_job_ids)
+                for job_id, job in list(self.polled_jobs.items()):
+                    if job_id not in active and not job.checking:
+                        del self.polled_jobs[job_id]
+            due_jobs = []
+            while self.schedule and self.schedule[0][0] <= now:
+                next_check, job_id = heapq.heappop(self.schedule)
+                job = self.polled_jobs.get(job_id, None)
+                if job is None or job.next_check != next_check:
+                    # Entry of a job no longer active
+                    continue
+                job.checking = True
+                due_jobs.append(job)
+            return due_jobs
+
+    def _time_to_next_check(self, now):
+        # Wake up at least every min_polling_interval to pick up new jobs
+        to_sleep = self.stateful_manager.min_polling_seconds
+        with self.lock:
+            if self.schedule:
+                to_sleep = min(to_sleep, self.schedule[0][0] - now)
+        return max(to_sleep, 0)
+
+    def _work(self):
+        while True:
+            item = self.work_queue.get()
+            if item is STOP_SIGNAL:
+                return
+            job, proxied_status = item
+            lag = max(time.time() - job.next_check, 0)
+            job_status = None
             try:
-                self._check_active_job_status(active_job_id)
+                job_status = self._check_active_job_status(job.job_id, proxied_status)
             except Exception:
-                log.exception("Failed checking active job status for job_id %s" % active_job_id)
-        iteration_end = datetime.datetime.now()
-        iteration_length = iteration_end - iteration_start
-        if iteration_length < self.stateful_manager.min_polling_interval:
-            to_sleep = (self.stateful_manager.min_polling_interval - iteration_length)
-            time.sleep(to_sleep.total_seconds())
-
-    def _check_active_job_status(self, active_job_id):
+                log.exception("Failed checking active job status for job_id %s" % job.job_id)
+            self._reschedule(job, job_status, lag)
+
+    def _reschedule(self, job, job_status, lag):
+        manager = self.stateful_manager
+        with self.lock:
+            self.polls += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            job.polls += 1
+            if job_status is not None and job_status != job.status:
+                job.status = job_status
+                job.interval = manager.min_polling_seconds
+            else:
+                job.interval = min(job.interval * manager.polling_backoff, manager.max_polling_seconds)
+            job.next_check = time.time() + job.interval
+            job.checking = False
+            if job.job_id in self.polled_jobs:
+                heapq.heappush(self.schedule, (job.next_check, job.job_id))
+
+    def _check_active_job_status(self, active_job_id, proxied_status=None):
         # Manager itself will handle state transitions when status changes,
         # just need to poll get_statu
-        self.stateful_manager.get_status(active_job_id)
+        return self.stateful_manager.get_status(active_job_id, proxied_status)
+
+
+class PolledJob(object):
+    """ Polling state of an active job in ManagerMonitor.
+    """
+
+    def __init__(self, job_id, next_check, interval):
+        self.job_id = job_id
+        self.next_check = next_check
+        self.interval = interval
+        self.status = None
+        self.polls = 0
+        self.checking = False
 
 
 def new_thread_for_manager(manager, name, target, daemon):
@@ -7,7 +7,7 @@ try:
 except ImportError:
     # Not in Galaxy, map Galaxy job states to LWR ones.
     from galaxy.util import enum
-    job_states = enum(RUNNING='running', OK='complete', QUEUED='queued')
+    job_states = enum(RUNNING='running', OK='complete', QUEUED='queued', ERROR='failed')
 
 from ..job import BaseJobExec
 
@@ -87,6 +87,15 @@ def kill(manager, job_id):
     manager.kill(job_id)
 
 
+@LwrController(response_type='json')
+def monitor_metrics(manager):
+    """ Returns {active_jobs: <int>, polls: <int>, mean_lag: <float>,
+    max_lag: <float>, queued_checks: <int>} or null if the manager's jobs
+    are not monitored.
+    """
+    return manager.monitor_metrics()
+
+
 # Following routes allow older clients to talk to new LWR, should be considered
 # deprecated in favor of generic upload_file route.
 @LwrController(response_type='json')
@@ -193,25 +202,36 @@ def _output_path(manager, job_id, name, output_type):
 
 
 @LwrController(response_type='json')
-def file_available(file_cache, ip, path):
+def file_available(file_cache, ip, path, digest=None):
     """ Returns {token: <token>, ready: <bool>}
+
+    With a content addressed cache the sha256 digest of the file may be
+    given and token is then the digest once the file is cached.
     """
-    return file_cache.file_available(ip, path)
+    return file_cache.file_available(ip, path, digest=digest)
 
 
 @LwrController(response_type='json')
-def cache_required(file_cache, ip, path):
+def cache_required(file_cache, ip, path, digest=None):
     """ Returns bool indicating whether this client should
     execute cache_insert. Either way client should be follow up
     with file_available.
     """
-    return file_cache.cache_required(ip, path)
+    return file_cache.cache_required(ip, path, digest=digest)
 
 
 @LwrController(response_type='json')
-def cache_insert(file_cache, ip, path, body):
+def cache_insert(file_cache, ip, path, body, digest=None):
     temp_path = copy_to_temp(body)
-    file_cache.cache_file(temp_path, ip, path)
+    file_cache.cache_file(temp_path, ip, path, digest=digest)
+
+
+@LwrController(response_type='json')
+def cache_stats(file_cache):
+    """ Returns {hits: <int>, misses: <int>, evictions: <int>, bytes: <int>,
+    max_bytes: <int or null>}
+    """
+    return file_cache.stats()
 
 
 # TODO: coerce booleans and None values into correct types - simplejson may
@@ -293,8 +313,7 @@ class LwrDataset(object):
 def _handle_upload(file_cache, path, body, cache_token=None):
     source = body
     if cache_token:
-        cached_file = file_cache.destination(cache_token)
-        source = open(cached_file, 'rb')
-        log.info("Copying cached file %s to %s" % (cached_file, path))
+        source = file_cache.open_file(cache_token)
+        log.info("Copying cached file %s to %s" % (file_cache.destination(cache_token), path))
     copy_to_path(source, path)
     return {"path": path}
@@ -0,0 +1,70 @@
+from os import makedirs
+from os.path import exists, join
+
+from lwr.managers import stateful
+from lwr.managers.stateful import ActiveJobs
+from .test_utils import TempDirectoryTestCase
+
+from galaxy.util.bunch import Bunch
+
+
+class ActiveJobsTest(TempDirectoryTestCase):
+
+    def setUp(self):
+        super(ActiveJobsTest, self).setUp()
+        self.manager = Bunch(name="test", persistence_directory=self.temp_directory)
+
+    def _reload(self, active_jobs):
+        active_jobs.close()
+        return ActiveJobs(self.manager)
+
+    def test_replayed_on_restart(self):
+        active_jobs = ActiveJobs(self.manager)
+        active_jobs.activate_job("1")
+        active_jobs.activate_job("2")
+        active_jobs.activate_job("3")
+        active_jobs.deactivate_job("2")
+        assert sorted(active_jobs.active_job_ids()) == ["1", "3"]
+        active_jobs = self._reload(active_jobs)
+        assert sorted(active_jobs.active_job_ids()) == ["1", "3"]
+        active_jobs.close()
+
+    def test_torn_entry_ignored(self):
+        active_jobs = ActiveJobs(self.manager)
+        active_jobs.activate_job("1")
+        active_jobs.close()
+        with open(join(self.temp_directory, "test-active-jobs.journal"), "a") as journal:
+            journal.write("- 1")
+        active_jobs = ActiveJobs(self.manager)
+        assert active_jobs.active_job_ids() == ["1"]
+        active_jobs.close()
+
+    def test_compaction(self):
+        slack = stateful.JOURNAL_COMPACT_SLACK
+        stateful.JOURNAL_COMPACT_SLACK = 2
+        try:
+            active_jobs = ActiveJobs(self.manager)
+            for i in range(20):
+                active_jobs.activate_job(str(i))
+                active_jobs.deactivate_job(str(i))
+            active_jobs.activate_job("final")
+            with open(active_jobs.journal_path) as journal:
+                assert len(journal.readlines()) <= 4
+            active_jobs = self._reload(active_jobs)
+            assert active_jobs.active_job_ids() == ["final"]
+            active_jobs.close()
+        finally:
+            stateful.JOURNAL_COMPACT_SLACK = slack
+
+    def test_imports_active_job_directory(self):
+        directory = join(self.temp_directory, "test-active-jobs")
+        makedirs(directory)
+        open(join(directory, "4"), "w").close()
+        active_jobs = ActiveJobs(self.manager)
+        assert active_jobs.active_job_ids() == ["4"]
+        active_jobs.deactivate_job("4")
+        active_jobs = self._reload(active_jobs)
+        # The journal takes over, the directory is only read the first time
+        assert active_jobs.active_job_ids() == []
+        assert exists(join(directory, "4"))
+        active_jobs.close()
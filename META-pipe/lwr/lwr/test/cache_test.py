@@ -1,10 +1,15 @@
+import shelve
 from os import remove
-from os.path import exists
+from os.path import exists, join
+from hashlib import sha256
 from tempfile import mkdtemp, NamedTemporaryFile
 from .test_utils import TestCase
 
 from lwr.cache import Cache
+from lwr.cache.persistence import whichdb
+from lwr.cache.util import Time
 from shutil import rmtree
+from threading import Thread
 
 
 class CacheTest(TestCase):
@@ -34,3 +39,112 @@ class CacheTest(TestCase):
         assert not cache.file_available("127.0.0.2", "/galaxy/dataset10001.dat")["ready"]
         cache.cache_file(self.temp_file.name, "127.0.0.2", "/galaxy/dataset10001.dat")
         assert cache.file_available("127.0.0.2", "/galaxy/dataset10001.dat")["ready"]
+
+    def test_hits_and_misses_counted(self):
+        cache = self.cache
+        cache.cache_required("127.0.0.2", "/galaxy/dataset10001.dat")
+        cache.cache_required("127.0.0.2", "/galaxy/dataset10001.dat")
+        stats = cache.stats()
+        assert stats["misses"] == 1
+        assert stats["hits"] == 1
+
+
+class ContentAddressedCacheTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.cache = Cache(self.temp_dir, content_addressed=True, max_bytes=30)
+
+    def tearDown(self):
+        self.cache.close()
+        rmtree(self.temp_dir)
+
+    def _insert(self, ip, path, contents):
+        temp_file = NamedTemporaryFile(dir=self.temp_dir, delete=False)
+        temp_file.write(contents)
+        temp_file.close()
+        self.cache.cache_required(ip, path)
+        self.cache.cache_file(temp_file.name, ip, path)
+        return self.cache.file_available(ip, path)
+
+    def test_same_contents_stored_once(self):
+        first = self._insert("127.0.0.2", "/galaxy/dataset1.dat", b"Hello World!")
+        second = self._insert("127.0.0.3", "/other/dataset2.dat", b"Hello World!")
+        assert first["ready"] and second["ready"]
+        assert first["token"] == second["token"] == sha256(b"Hello World!").hexdigest()
+        assert self.cache.stats()["bytes"] == 12
+
+    def test_known_digest_needs_no_upload(self):
+        available = self._insert("127.0.0.2", "/galaxy/dataset1.dat", b"Hello World!")
+        assert not self.cache.cache_required("127.0.0.3", "/other/dataset2.dat", digest=available["token"])
+        assert self.cache.file_available("127.0.0.3", "/other/dataset2.dat")["ready"]
+
+    def test_least_recently_used_evicted(self):
+        first = self._insert("127.0.0.2", "/galaxy/dataset1.dat", b"A" * 12)
+        self._insert("127.0.0.2", "/galaxy/dataset2.dat", b"B" * 12)
+        # Using the first file makes the second the least recently used
+        self.cache.file_available("127.0.0.2", "/galaxy/dataset1.dat")
+        self._insert("127.0.0.2", "/galaxy/dataset3.dat", b"C" * 12)
+        assert self.cache.file_available("127.0.0.2", "/galaxy/dataset1.dat")["ready"]
+        assert not self.cache.file_available("127.0.0.2", "/galaxy/dataset2.dat")["ready"]
+        assert exists(self.cache.destination(first["token"]))
+        stats = self.cache.stats()
+        assert stats["evictions"] == 1
+        assert stats["bytes"] == 24
+        # An evicted file has to be uploaded again
+        assert self.cache.cache_required("127.0.0.2", "/galaxy/dataset2.dat")
+
+    def test_evicting_drops_every_alias(self):
+        first = self._insert("127.0.0.2", "/galaxy/dataset1.dat", b"A" * 12)
+        assert not self.cache.cache_required("127.0.0.3", "/other/dataset1.dat", digest=first["token"])
+        opened = self.cache.open_file(first["token"])
+        self._insert("127.0.0.2", "/galaxy/dataset2.dat", b"B" * 12)
+        self._insert("127.0.0.2", "/galaxy/dataset3.dat", b"C" * 12)
+        assert not self.cache.file_available("127.0.0.2", "/galaxy/dataset1.dat")["ready"]
+        assert not self.cache.file_available("127.0.0.3", "/other/dataset1.dat")["ready"]
+        assert self.cache.cache_required("127.0.0.3", "/other/dataset1.dat")
+        # A file opened before it was evicted can still be read
+        with opened:
+            assert opened.read() == b"A" * 12
+
+    def test_invalid_digest_rejected(self):
+        with self.assertRaises(ValueError):
+            self.cache.cache_required("127.0.0.2", "/galaxy/dataset1.dat", digest="../../etc/passwd")
+
+
+class CacheStoreTest(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_migrates_shelf(self):
+        shelf = shelve.open(join(self.temp_dir, "cache_shelf"))
+        shelf[sha256(b"IP:127.0.0.2:/galaxy/dataset10001.dat").hexdigest()] = Time.now()
+        shelf.close()
+        cache = Cache(self.temp_dir)
+        try:
+            assert not cache.cache_required("127.0.0.2", "/galaxy/dataset10001.dat")
+            assert cache.cache_required("127.0.0.2", "/galaxy/dataset10002.dat")
+            # Old shelf files are set aside so they are only migrated once
+            assert not whichdb(join(self.temp_dir, "cache_shelf"))
+        finally:
+            cache.close()
+
+    def test_concurrent_cache_required(self):
+        cache = Cache(self.temp_dir)
+        required = []
+
+        def require():
+            for i in range(20):
+                required.append(cache.cache_required("127.0.0.2", "/galaxy/dataset%d.dat" % i))
+        threads = [Thread(target=require) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        cache.close()
+        assert required.count(True) == 20
+        assert required.count(False) == 80
@@ -0,0 +1,57 @@
+import tempfile
+from shutil import rmtree
+
+from lwr.managers import status
+from lwr.managers.queued_cli import CliQueueManager
+from lwr.managers.util.cli.job.slurm import Slurm
+from galaxy.util.bunch import Bunch
+from galaxy.jobs.metrics import NULL_JOB_INSTRUMENTER
+
+from .test_utils import TestCase
+from .test_utils import TestAuthorizer
+from .test_utils import TestDependencyManager
+
+SQUEUE_OUTPUT = """JOBID ST
+101 R
+102 PD
+"""
+
+
+class StubShell(object):
+
+    def __init__(self):
+        self.commands = []
+
+    def execute(self, cmd, **kwds):
+        self.commands.append(cmd)
+        if cmd.endswith("-j 103"):
+            return Bunch(returncode=0, stdout="JOBID ST\n", stderr="")
+        return Bunch(returncode=0, stdout=SQUEUE_OUTPUT, stderr="")
+
+
+class CliQueueManagerTest(TestCase):
+
+    def setUp(self):
+        self.staging_directory = tempfile.mkdtemp()
+        app = Bunch(staging_directory=self.staging_directory,
+                    authorizer=TestAuthorizer(),
+                    job_metrics=Bunch(default_job_instrumenter=NULL_JOB_INSTRUMENTER),
+                    dependency_manager=TestDependencyManager())
+        self.manager = CliQueueManager("test", app, job_plugin="Slurm")
+        self.shell = StubShell()
+        self.manager.cli_interface = Bunch(get_plugins=lambda shell_params, job_params: (self.shell, Slurm()))
+
+    def tearDown(self):
+        rmtree(self.staging_directory)
+
+    def test_statuses_with_one_query(self):
+        job_ids = []
+        for external_id in ["101", "102", "103"]:
+            job_id = self.manager.setup_job(external_id, "tool1", "1.0.0")
+            self.manager._register_external_id(job_id, external_id)
+            job_ids.append(job_id)
+        statuses = self.manager.get_statuses(job_ids)
+        assert len(self.shell.commands) == 1
+        assert statuses == {job_ids[0]: status.RUNNING, job_ids[1]: status.QUEUED}
+        # A job missing from the listing is left to a single status query
+        assert self.manager.get_status(job_ids[2]) == status.COMPLETE
@@ -0,0 +1,92 @@
+import threading
+import time
+
+from lwr.managers import status
+from lwr.managers.stateful import ManagerMonitor, PolledJob
+from galaxy.util.bunch import Bunch
+
+from .test_utils import TestCase
+
+# Generous, conditions are normally met within a fraction of a second
+TIMEOUT = 10
+
+
+def wait_for(condition, timeout=TIMEOUT):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class StubStatefulManager(object):
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.checks = []
+        self.min_polling_seconds = 0.05
+        self.max_polling_seconds = 0.2
+        self.polling_backoff = 2.0
+        self.monitor_threads = 2
+        self.active_jobs = Bunch(active_job_ids=lambda: list(self.statuses.keys()))
+        self.slow_check_started = threading.Event()
+        self.release_slow_check = threading.Event()
+
+    def get_proxied_statuses(self, job_ids):
+        return {}
+
+    def get_status(self, job_id, proxied_status=None):
+        self.checks.append(job_id)
+        if job_id == "slow":
+            self.slow_check_started.set()
+            self.release_slow_check.wait(TIMEOUT)
+        return self.statuses[job_id]
+
+
+class ManagerMonitorTest(TestCase):
+
+    def test_backoff_and_reset(self):
+        manager = StubStatefulManager({})
+        monitor = ManagerMonitor(manager)
+        monitor.shutdown()
+        job = PolledJob("1", time.time(), manager.min_polling_seconds)
+        intervals = []
+        for job_status in [status.RUNNING, status.RUNNING, status.RUNNING, status.RUNNING, status.COMPLETE]:
+            monitor._reschedule(job, job_status, 0.0)
+            intervals.append(job.interval)
+        # Unchanged status backs off to the cap, a new status starts over
+        assert intervals == [0.05, 0.1, 0.2, 0.2, 0.05], intervals
+        assert job.status == status.COMPLETE
+        assert job.polls == 5
+
+    def test_polls_back_off(self):
+        manager = StubStatefulManager({"1": status.RUNNING})
+        monitor = ManagerMonitor(manager)
+        try:
+            assert wait_for(lambda: "1" in monitor.polled_jobs and monitor.polled_jobs["1"].interval == 0.2)
+            assert manager.checks.count("1") >= 3
+        finally:
+            monitor.shutdown()
+        metrics = monitor.metrics()
+        assert metrics["polls"] == len(manager.checks)
+        assert metrics["active_jobs"] == 1
+
+    def test_slow_check_does_not_block_others(self):
+        manager = StubStatefulManager({"slow": status.RUNNING, "fast": status.QUEUED})
+        monitor = ManagerMonitor(manager)
+        try:
+            assert manager.slow_check_started.wait(TIMEOUT)
+            assert wait_for(lambda: manager.checks.count("fast") >= 2)
+            assert manager.checks.count("slow") == 1
+        finally:
+            manager.release_slow_check.set()
+            monitor.shutdown()
+
+    def test_finished_jobs_dropped(self):
+        manager = StubStatefulManager({"1": status.RUNNING})
+        monitor = ManagerMonitor(manager)
+        try:
+            assert wait_for(lambda: "1" in manager.checks)
+            del manager.statuses["1"]
+            assert wait_for(lambda: not monitor.polled_jobs and not monitor.schedule)
+        finally:
+            monitor.shutdown()
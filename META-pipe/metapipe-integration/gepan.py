@@ -1,5 +1,10 @@
 import sys
 import os
+import argparse
+import hashlib
+import json
+import re
+import time
 import logging
 import drmaa
 import subprocess
@@ -12,6 +17,148 @@ STATUS_TERMINATED = "terminated"
 STATUS_UNKNOWN = "unknown: (software bug)"
 
 FILE_TERMINATED = "TERMINATED"
+FILE_MANIFEST = "manifest.json"
+
+# Bytes read at a time when checksumming result files
+CHECKSUM_BLOCK = 1024 * 1024
+
+# Lines in any log file that mean a task of the job failed
+FAILURE_PATTERNS = [
+    'ERROR',
+    '^mv: cannot stat',
+    '^cp: cannot stat',
+    '^Error:'
+]
+
+# Seconds between two task status queries while waiting for a job
+POLL_INTERVAL = 10
+
+# Task states that never change again, so they are not queried twice
+FINAL_STATES = (drmaa.JobState.DONE, drmaa.JobState.FAILED)
+
+
+class LogScanner:
+    """Scans a log directory for failure patterns, reading only what was appended since the last scan."""
+    def __init__(self, log_dir, patterns=FAILURE_PATTERNS):
+        self.log_dir = log_dir
+        self.patterns = [(p, re.compile(p, re.MULTILINE)) for p in patterns]
+        # path -> (inode, offset of the first byte not scanned yet)
+        self.offsets = {}
+        self.matched = set()
+
+    def scan(self):
+        """Returns the patterns matched in any log file so far."""
+        for root, dirs, files in os.walk(self.log_dir):
+            for name in files:
+                self.scan_file(os.path.join(root, name))
+        return [p for p, regex in self.patterns if p in self.matched]
+
+    def scan_file(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        inode, offset = self.offsets.get(path, (st.st_ino, 0))
+        if inode != st.st_ino or st.st_size < offset:
+            # Replaced or truncated, start over
+            offset = 0
+        if st.st_size == offset:
+            return
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(st.st_size - offset)
+        for p, regex in self.patterns:
+            if p not in self.matched and regex.search(data):
+                self.matched.add(p)
+        # A last line without a line break is scanned again next time, it may still be written
+        end = data.rfind('\n') + 1
+        self.offsets[path] = (st.st_ino, offset + end)
+
+
+class StatusService:
+    """Answers status queries for many jobs with one DRMAA session and cached task ids and log scans."""
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.drmaa_session = None
+        # log_dir -> (directory mtime, task ids)
+        self.task_id_cache = {}
+        self.scanners = {}
+        self.final_states = {}
+        # manifest path -> (file mtime, entries), read or hashed once per job
+        self.manifests = {}
+        # While answering a batch of jobs, every task is queried at most once
+        self.pass_states = None
+
+    def session(self):
+        if self.drmaa_session is None:
+            self.drmaa_session = drmaa.Session()
+            self.drmaa_session.initialize()
+        return self.drmaa_session
+
+    def close(self):
+        if self.drmaa_session is not None:
+            self.drmaa_session.exit()
+            self.drmaa_session = None
+
+    def tasks(self, log_dir):
+        """(name, task id) of every logs/<name>.jid.log file."""
+        # The *.jid.log files are only created at submission, which changes the directory mtime
+        mtime = os.stat(log_dir).st_mtime
+        cached = self.task_id_cache.get(log_dir)
+        if cached is not None and cached[0] == mtime:
+            return list(cached[1])
+        task_files = [f for f in os.listdir(log_dir) if f.endswith(".jid.log")]
+
+        def get_task(filename):
+            path = os.path.join(log_dir, filename)
+            with open(path) as f:
+                return filename[:-len(".jid.log")], f.read().rstrip('\n\r')
+        tasks = map(get_task, task_files)
+        # An empty id may still be on its way into the file, so do not keep it
+        if '' not in [jid for name, jid in tasks]:
+            self.task_id_cache[log_dir] = (mtime, tasks)
+        return list(tasks)
+
+    def task_ids(self, log_dir):
+        return [jid for name, jid in self.tasks(log_dir)]
+
+    def task_status(self, job_ids):
+        """The DRMAA state of every task, querying only the tasks that have not finished."""
+        session = None
+        statuses = []
+        for jid in job_ids:
+            state = self.final_states.get(jid)
+            if state is None and self.pass_states is not None:
+                state = self.pass_states.get(jid)
+            if state is None:
+                if session is None:
+                    session = self.session()
+                state = session.jobStatus(jid)
+                if state in FINAL_STATES:
+                    self.final_states[jid] = state
+                elif self.pass_states is not None:
+                    self.pass_states[jid] = state
+            statuses.append(state)
+        self.logger.debug("statuses: " + str(statuses))
+        return statuses
+
+    def cached_manifest(self, path):
+        """Entries of a written manifest, None while there is none."""
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        cached = self.manifests.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path) as f:
+                cached = self.manifests[path] = (mtime, json.load(f))
+        return cached[1]
+
+    def failure_patterns(self, log_dir):
+        scanner = self.scanners.get(log_dir)
+        if scanner is None:
+            scanner = self.scanners[log_dir] = LogScanner(log_dir)
+        return scanner.scan()
 
 
 class JobManager:
@@ -24,6 +171,7 @@ class JobManager:
         self.result_dir = os.path.join(self.job_dir, 'results')
         self.shell_dir = os.path.join(self.job_dir, 'shells')
         self.submit_jobs_script = os.path.join(self.shell_dir, 'submit_jobs.sh')
+        self.service = gepan.service
 
     def status(self):
         if not self.job_started():
@@ -32,11 +180,45 @@ class JobManager:
             return STATUS_TERMINATED
         if self.job_running():
             return STATUS_RUNNING
+        self.finish()
         if self.job_failed():
             return STATUS_FAILED
         # If the job has been started, but its not running nor failed then it must have succeeded.
         return STATUS_SUCCEEDED
 
+    def describe(self):
+        """Status, task states, task timings and result file sizes of the job, for JSON output."""
+        description = {'job_id': self.job_id, 'status': self.status()}
+        if not self.job_started():
+            return description
+        tasks = self.service.tasks(self.log_dir) if os.path.isdir(self.log_dir) else []
+        ids = [jid for name, jid in tasks if jid != '']
+        states = dict(zip(ids, self.drmaa_task_status(ids)))
+        description['tasks'] = [{'name': name, 'id': jid, 'state': states.get(jid)} for name, jid in tasks]
+        description['timings'] = self.timings()
+        if os.path.isdir(self.result_dir):
+            description['results'] = [{'file': entry['file'], 'size': entry['size']} for entry in self.manifest()]
+        return description
+
+    def timings(self):
+        """Start and stop time of every step, from the logs/<step>.<host>.time.log files written with -P."""
+        timings = {}
+        if not os.path.isdir(self.log_dir):
+            return timings
+        for filename in os.listdir(self.log_dir):
+            if not filename.endswith('.time.log'):
+                continue
+            with open(os.path.join(self.log_dir, filename)) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 3 and fields[1] in ('start:', 'stop:') and fields[2].isdigit():
+                        timing = timings.setdefault(fields[0], {})
+                        timing[fields[1][:-1]] = int(fields[2])
+        for timing in timings.values():
+            if 'start' in timing and 'stop' in timing:
+                timing['seconds'] = timing['stop'] - timing['start']
+        return timings
+
     def job_started(self):
         return self.job_dir_exists()
 
@@ -62,51 +244,80 @@ class JobManager:
         return False
 
     def individual_job_failed(self):
-        def match_pattern(pattern):
-            with open(os.devnull, 'wb') as f:
-                if subprocess.call(['grep', '-r', pattern, self.log_dir], stdout=f) == 0:
-                    return True
-        patterns = [
-            'ERROR',
-            '^mv: cannot stat',
-            '^cp: cannot stat',
-            '^Error:'
-        ]
-        job_failed = False
+        patterns = self.service.failure_patterns(self.log_dir)
         for p in patterns:
-            if match_pattern(p):
-                self.logger.warn("Job failed! Failure detected by running 'grep' in the log directory with the " +
-                                 "following pattern: '%s'" % p)
-                job_failed = True
-
-        return job_failed
+            self.logger.warn("Job failed! Failure detected by scanning the log directory for the " +
+                             "following pattern: '%s'" % p)
+        return len(patterns) > 0
 
     def copy_results_failed(self):
-        # Verify existence of output file
-        # Verify that output file size > 0B
+        entries = self.manifest()
+        if len(entries) == 0:
+            self.logger.warn("Job failed! No result files in '%s'" % self.result_dir)
+            return True
+        for entry in entries:
+            try:
+                st = os.stat(entry['file'])
+            except OSError:
+                self.logger.warn("Job failed! Result file '%s' is missing" % entry['file'])
+                return True
+            if st.st_size == 0 or st.st_size != entry['size'] or int(st.st_mtime) != entry['mtime']:
+                self.logger.warn("Job failed! Result file '%s' is empty or changed since the manifest was written" %
+                                 entry['file'])
+                return True
         return False
 
+    def finish(self):
+        """Writes the result manifest once every task has been submitted and has finished."""
+        if self.file_exists(FILE_MANIFEST) or not os.path.isdir(self.result_dir):
+            return
+        ids = self.task_ids()
+        if len(ids) == 0 or ids.count('') > 0:
+            return
+        entries = self.scan_results()
+        path = os.path.join(self.job_dir, FILE_MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(entries, f, indent=1)
+        os.rename(path + '.tmp', path)
+        self.service.manifests[path] = (os.stat(path).st_mtime, entries)
+        self.logger.info("Wrote manifest of %d result files" % len(entries))
+
+    def scan_results(self):
+        """File, size, mtime and SHA-1 of every result file."""
+        entries = []
+        for filename in sorted(os.listdir(self.result_dir)):
+            path = os.path.join(self.result_dir, filename)
+            if not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            sha1 = hashlib.sha1()
+            with open(path, 'rb') as f:
+                block = f.read(CHECKSUM_BLOCK)
+                while block:
+                    sha1.update(block)
+                    block = f.read(CHECKSUM_BLOCK)
+            entries.append({'file': path, 'size': st.st_size, 'mtime': int(st.st_mtime), 'sha1': sha1.hexdigest()})
+        return entries
+
+    def manifest(self):
+        """The result manifest, or the current result files without checksums while the job has not finished."""
+        entries = self.service.cached_manifest(os.path.join(self.job_dir, FILE_MANIFEST))
+        if entries is not None:
+            return entries
+        entries = []
+        for path in self.list_results():
+            st = os.stat(path)
+            entries.append({'file': path, 'size': st.st_size, 'mtime': int(st.st_mtime)})
+        return entries
+
     def job_dir_exists(self):
         return os.path.exists(self.job_dir)
 
     def task_ids(self):
-        task_files = [f for f in os.listdir(self.log_dir) if f.endswith(".jid.log")]
-
-        def get_job_id(filename):
-            path = os.path.join(self.log_dir, filename)
-            with open(path) as f:
-                return f.read().rstrip('\n\r')
-        return map(get_job_id, task_files)
+        return self.service.task_ids(self.log_dir)
 
     def drmaa_task_status(self, job_ids):
-        session = drmaa.Session()
-        session.initialize()
-        try:
-            statuses = [session.jobStatus(jid) for jid in job_ids]
-            self.logger.debug("statuses: " + str(statuses))
-        finally:
-            session.exit()
-        return statuses
+        return self.service.task_status(job_ids)
 
     def is_drmaa_job_running(self, statuses):
         # When Torque no longer keeps track of a job the job is marked as 'failed',
@@ -121,16 +332,43 @@ class JobManager:
         else:
             return True
 
-    def wait_for(self):
+    def wait_for(self, timeout=None, stop_on_failure=False, poll_interval=POLL_INTERVAL, progress=None):
+        """Polls all tasks until they are finished, the job fails or timeout seconds have passed.
+
+        The tasks are submitted by the shell scripts, not by our DRMAA session, so
+        they can not be waited on as a session and are polled together instead.
+        progress(task_id, state, finished, total) is called for every task that
+        finishes. On the first failure the remaining tasks are stopped if
+        stop_on_failure is set."""
         ids = self.task_ids()
-        session = drmaa.Session()
-        session.initialize()
-        try:
-            self.logger.info("Waiting for the following jobs to complete: " + str(ids))
-            for id in ids:
-                session.wait(id, drmaa.Session.TIMEOUT_WAIT_FOREVER)
-        finally:
-            session.exit()
+        self.logger.info("Waiting for the following jobs to complete: " + str(ids))
+        started = time.time()
+        pending = list(ids)
+        finished = 0
+        while True:
+            if self.job_submission_failed() or self.individual_job_failed():
+                self.logger.warn("Job failed with %d of %d tasks unfinished" % (len(pending), len(ids)))
+                if stop_on_failure and pending:
+                    self.stop()
+                return STATUS_FAILED
+            if self.terminated():
+                return STATUS_TERMINATED
+            unfinished = []
+            for jid, state in zip(pending, self.drmaa_task_status(pending)):
+                if state in FINAL_STATES:
+                    finished += 1
+                    self.logger.info("Task %s finished (%s) after %d seconds" % (jid, state, time.time() - started))
+                    if progress is not None:
+                        progress(jid, state, finished, len(ids))
+                else:
+                    unfinished.append(jid)
+            pending = unfinished
+            if not pending:
+                break
+            if timeout is not None and time.time() - started >= timeout:
+                self.logger.warn("Timed out after %d seconds waiting for tasks: %s" % (timeout, str(pending)))
+                break
+            time.sleep(poll_interval if timeout is None else max(0, min(poll_interval, started + timeout - time.time())))
         status = self.status()
         self.logger.info("Job finished with the following status: " + status)
         return status
@@ -140,19 +378,15 @@ class JobManager:
         ids = self.task_ids()
         not_terminated = []
         self.logger.info("Terminating jobs: " + str(ids))
-        session = drmaa.Session()
-        session.initialize()
-        try:
-            for jid in ids:
-                try:
-                    session.control(jid, drmaa.JobControlAction.TERMINATE)
-                except drmaa.InvalidJobException:
-                    not_terminated.append(jid)
-                except Exception as e:
-                    self.logger.warn("Unexpected exception when terminating job (%s):" % jid, e)
-                    not_terminated.append(jid)
-        finally:
-            session.exit()
+        session = self.service.session()
+        for jid in ids:
+            try:
+                session.control(jid, drmaa.JobControlAction.TERMINATE)
+            except drmaa.InvalidJobException:
+                not_terminated.append(jid)
+            except Exception as e:
+                self.logger.warn("Unexpected exception when terminating job (%s):" % jid, e)
+                not_terminated.append(jid)
         if len(not_terminated) > 0:
             self.logger.debug("Did not terminate the following jobs as they did not exist (any more?): " + str(not_terminated))
 
@@ -167,6 +401,11 @@ class JobManager:
         return STATUS_RUNNING
 
     def result(self):
+        return [entry['file'] for entry in self.manifest()]
+
+    def list_results(self):
+        if not os.path.isdir(self.result_dir):
+            return []
         files = os.listdir(self.result_dir)
         return map(lambda fn: os.path.join(self.result_dir, fn), files)
 
@@ -207,6 +446,11 @@ class Gepan:
     def __init__(self, gepan_work_dir, gepan_home):
         self.work_dir = gepan_work_dir
         self.gepan_start_script = os.path.join(gepan_home, 'start_gepan.sh')
+        # Shared by all job managers, DRMAA allows a single session per process
+        self.service = StatusService()
+
+    def close(self):
+        self.service.close()
 
     def status(self, job_id):
         manager = JobManager(self, job_id)
@@ -221,14 +465,37 @@ class Gepan:
         manager.stop()
         return STATUS_TERMINATED
 
-    def wait_for(self, job_id):
+    def wait_for(self, job_id, timeout=None, stop_on_failure=False, poll_interval=POLL_INTERVAL, progress=None):
         manager = JobManager(self, job_id)
-        return manager.wait_for()
+        return manager.wait_for(timeout=timeout, stop_on_failure=stop_on_failure, poll_interval=poll_interval,
+                                progress=progress)
 
     def result(self, job_id):
         manager = JobManager(self, job_id)
         return manager.result()
 
+    def describe(self, job_ids):
+        self.service.pass_states = {}
+        try:
+            return [self.describe_job(job_id) for job_id in job_ids]
+        finally:
+            self.service.pass_states = None
+
+    def describe_job(self, job_id):
+        """One job of describe(), a directory that is not (yet) a job reports its error instead."""
+        try:
+            return JobManager(self, job_id).describe()
+        except (OSError, IOError) as e:
+            logging.getLogger(self.__class__.__name__).warn("Failed to describe job %s: %s" % (job_id, e))
+            return {'job_id': job_id, 'error': str(e)}
+
+    def job_ids(self):
+        return sorted([d for d in os.listdir(self.work_dir) if os.path.isdir(os.path.join(self.work_dir, d))])
+
+    def manifest(self, job_id):
+        manager = JobManager(self, job_id)
+        return manager.manifest()
+
     def directory(self, job_id):
         manager = JobManager(self, job_id)
         return manager.job_dir
@@ -239,11 +506,36 @@ def main():
     gepan_home = os.environ['GEPAN_HOME']
 
     cmd = sys.argv[1]
-    job_id = sys.argv[2]
-    args = sys.argv[3:]
 
     gepan = Gepan(gepan_work_dir=work_dir, gepan_home=gepan_home)
-
+    try:
+        if cmd == 'status-many':
+            status_many(gepan, sys.argv[2:])
+        else:
+            run(gepan, cmd, sys.argv[2], sys.argv[3:])
+    finally:
+        gepan.close()
+
+
+def status_many(gepan, args):
+    parser = argparse.ArgumentParser(prog='gepan.py status-many')
+    parser.add_argument('job_ids', nargs='*', help='Jobs to report on')
+    parser.add_argument('--all', action='store_true', help='Report on every job under GEPAN_WORK_DIR')
+    parser.add_argument('--watch', type=float, help='Keep reporting, one JSON line every this many seconds')
+    options = parser.parse_args(args)
+    if not options.all and not options.job_ids:
+        parser.error('give job ids or --all')
+
+    while True:
+        job_ids = gepan.job_ids() if options.all else options.job_ids
+        print json.dumps(gepan.describe(job_ids))
+        sys.stdout.flush()
+        if options.watch is None:
+            break
+        time.sleep(options.watch)
+
+
+def run(gepan, cmd, job_id, args):
     if cmd == 'start':
         gepan.start(job_id=job_id, args=args + ['-R', '-P'])
     elif cmd == 'status':
@@ -251,11 +543,23 @@ def main():
     elif cmd == 'stop':
         gepan.stop(job_id=job_id)
     elif cmd == 'wait_for':
-        print gepan.wait_for(job_id=job_id)
+        parser = argparse.ArgumentParser(prog='gepan.py wait_for <job_id>')
+        parser.add_argument('--timeout', type=float, help='Give up waiting after this many seconds')
+        parser.add_argument('--stop-on-failure', action='store_true', help='Stop the remaining tasks when one fails')
+        parser.add_argument('--interval', type=float, default=POLL_INTERVAL, help='Seconds between status queries')
+        options = parser.parse_args(args)
+
+        def progress(task_id, state, finished, total):
+            print "%s %s (%d/%d)" % (task_id, state, finished, total)
+            sys.stdout.flush()
+        print gepan.wait_for(job_id=job_id, timeout=options.timeout, stop_on_failure=options.stop_on_failure,
+                             poll_interval=options.interval, progress=progress)
     elif cmd == 'result':
         files = gepan.result(job_id=job_id)
         for file_name in files:
             print file_name
+    elif cmd == 'manifest':
+        print json.dumps(gepan.manifest(job_id=job_id), indent=1)
     elif cmd == 'directory' or cmd == 'dir':
         print gepan.directory(job_id)
     else:
@@ -1,74 +1,271 @@
 #!/usr/bin/env python2.7
 import sys
 import argparse
+import glob
+import heapq
 import math
-from collections import deque
-#from collections import deque
 import os
-import cProfile
 
-class sequence:
-  def __init__(self, seq_id):
-    self.seq_id = seq_id
-    self.sequence = ""
-    self.length = len(self.seq_id)
+COPY_BLOCK = 1024 * 1024
+# Shards must differ this much in size before a per-shard overhead is fitted
+SPREAD = 1.5
 
-  def add_line(self, line):
-    self.sequence += line
-    self.length += len(line)
+class record:
+  """Where a sequence lives in the input file, its text is never kept."""
+  __slots__ = ("offset", "size", "residues")
 
-  def print_all(self):
-    return self.seq_id + self.sequence
+  def __init__(self, offset):
+    self.offset = offset
+    self.size = 0
+    self.residues = 0
 
-  def get_length(self):
-    return self.length
+def scan(path):
+  """First pass: the byte offset, byte size and residue count of every sequence."""
+  records = list()
+  current = None
+  offset = 0
+  inputFile = open(path, "rb")
+  for line in inputFile:
+    if(line.startswith(">")):
+      current = record(offset)
+      records.append(current)
+    elif(current != None):
+      current.residues += len(line.rstrip("\r\n"))
+    if(current != None):
+      current.size += len(line)
+    offset += len(line)
+  inputFile.close()
+  return records
+
+def pack(records, shards):
+  """Longest processing time first: each sequence, longest first, goes to the shard with the fewest residues."""
+  assignment = [list() for i in range(0, shards)]
+  totals = [0] * shards
+  heap = [(0, i) for i in range(0, shards)]
+  for rec in sorted(records, key=lambda rec: rec.residues, reverse=True):
+    total, i = heapq.heappop(heap)
+    assignment[i].append(rec)
+    totals[i] = total + rec.residues
+    heapq.heappush(heap, (totals[i], i))
+  return assignment, totals
+
+def copy_ranges(inputFile, outFile, records):
+  """Copies the byte ranges of the records, in input order, merging adjacent ones."""
+  ranges = list()
+  for rec in sorted(records, key=lambda rec: rec.offset):
+    if(ranges and ranges[-1][0] + ranges[-1][1] == rec.offset):
+      ranges[-1][1] += rec.size
+    else:
+      ranges.append([rec.offset, rec.size])
+  for offset, size in ranges:
+    inputFile.seek(offset)
+    while(size > 0):
+      block = inputFile.read(min(size, COPY_BLOCK))
+      if(not block):
+        break
+      outFile.write(block)
+      size -= len(block)
+
+def read_timings(logs, tool):
+  """Wall time in seconds of every array task of a tool, from the <tool>_<task>.<host>.time.log files of a GePan logs directory."""
+  timings = dict()
+  prefix = tool + "_"
+  for name in os.listdir(logs):
+    if(not name.startswith(prefix) or not name.endswith(".time.log")):
+      continue
+    task = name[len(prefix):].split(".")[0]
+    if(not task.isdigit()):
+      continue
+    start = None
+    for line in open(os.path.join(logs, name)):
+      splitLine = line.split()
+      if(len(splitLine) != 3 or not splitLine[2].isdigit()):
+        continue
+      if(splitLine[1] == "start:"):
+        start = int(splitLine[2])
+      elif(splitLine[1] == "stop:" and start != None):
+        # A rerun task appends another pair, the last complete one wins
+        timings[int(task)] = int(splitLine[2]) - start
+        start = None
+  return timings
+
+def read_plan(path):
+  """The database size per tool and the residues per shard recorded in a plan file."""
+  db_sizes = dict()
+  residues = dict()
+  for line in open(path):
+    splitLine = line.split()
+    if(not splitLine):
+      continue
+    if(splitLine[0] == "#"):
+      if(len(splitLine) == 4 and splitLine[1] == "tool"):
+        db_sizes[splitLine[2]] = float(splitLine[3])
+    elif(splitLine[0].isdigit()):
+      residues[int(splitLine[0])] = int(splitLine[3])
+  return db_sizes, residues
+
+class model:
+  """Predicted seconds of a shard: overhead + rate * residues * database size."""
+  __slots__ = ("tool", "db_size", "overhead", "rate", "points")
+
+  def __init__(self, tool, db_size, overhead, rate, points):
+    self.tool = tool
+    self.db_size = db_size
+    self.overhead = overhead
+    self.rate = rate
+    self.points = points
+
+  def seconds(self, residues):
+    return self.overhead + self.rate * residues * self.db_size
+
+def fit(tool, db_size, history, planName):
+  """Least squares fit of the model of a tool over the shards of earlier runs.
+
+  Every history directory is the logs directory of an earlier run, holding
+  the time logs of its tasks and the plan file the shards were cut by."""
+  points = list()
+  for logs in history:
+    plan = os.path.join(logs, planName)
+    if(not os.path.exists(plan)):
+      # A run that wrote its plan under another name still counts if it is the only one
+      plans = glob.glob(os.path.join(logs, "*.plan"))
+      if(len(plans) != 1):
+        continue
+      plan = plans[0]
+    db_sizes, residues = read_plan(plan)
+    for task, seconds in read_timings(logs, tool).items():
+      # Tasks of empty shards skip the tool
+      if(residues.get(task, 0) > 0):
+        points.append((residues[task] * db_sizes.get(tool, 1.0), seconds))
+  if(not points):
+    raise ValueError("No timings of " + tool + " found in " + ", ".join(history))
+  n = float(len(points))
+  meanX = sum([x for x, y in points]) / n
+  meanY = sum([y for x, y in points]) / n
+  sxx = sum([(x - meanX) ** 2 for x, y in points])
+  sxy = sum([(x - meanX) * (y - meanY) for x, y in points])
+  xs = [x for x, y in points]
+  if(min(xs) > 0 and max(xs) >= SPREAD * min(xs) and sxy > 0 and meanY - sxy / sxx * meanX >= 0):
+    rate = sxy / sxx
+    overhead = meanY - rate * meanX
+  else:
+    # Balanced shards are too alike to separate the overhead, assume there is none
+    overhead = 0.0
+    rate = meanY / meanX if meanX > 0 else 0.0
+  return model(tool, db_size, overhead, rate, len(points))
+
+def predict(models, residues):
+  """The slowest tool decides, all tools run on the same shards."""
+  return max([m.seconds(residues) for m in models])
+
+def plan_shards(records, models, target, limit):
+  """The fewest shards, at most limit, whose predicted wall time all stay within the target."""
+  total = sum([rec.residues for rec in records])
+  shards = 1
+  for m in models:
+    if(target > m.overhead and m.rate > 0):
+      shards = max(shards, int(math.ceil(m.rate * total * m.db_size / (target - m.overhead))))
+  shards = max(1, min(shards, limit))
+  assignment, totals = pack(records, shards)
+  while(shards < limit and predict(models, max(totals)) > target):
+    shards += 1
+    assignment, totals = pack(records, shards)
+  return assignment, totals
+
+def write_plan(path, inputPath, files, assignment, totals, tools, models, target):
+  out = open(path, "w")
+  out.write("# input " + inputPath + "\n")
+  # Shards past the planned ones are empty files padding out a fixed task array
+  out.write("# shards " + str(len([shard for shard in assignment if shard])) + "\n")
+  if(target != None):
+    out.write("# target_seconds " + str(target) + "\n")
+  for tool, db_size in tools:
+    out.write("# tool " + tool + " " + repr(db_size) + "\n")
+  for m in models:
+    out.write("# model " + m.tool + " overhead=%.3f rate=%.6g points=%d\n" % (m.overhead, m.rate, m.points))
+  out.write("#shard\tfile\tsequences\tresidues\tseconds\n")
+  for i in range(0, len(files)):
+    seconds = "%.1f" % predict(models, totals[i]) if models and assignment[i] else "-"
+    out.write("\t".join((str(i + 1), files[i], str(len(assignment[i])), str(totals[i]), seconds)) + "\n")
+  out.close()
+
+def tool_option(value):
+  """--tool ID or ID:DATABASE_SIZE"""
+  if(":" in value):
+    tool, db_size = value.rsplit(":", 1)
+    return (tool, float(db_size))
+  return (value, 1.0)
 
 def main(args):
-  parser = argparse.ArgumentParser(description='Split a fasta file into several smaller ones')
+  parser = argparse.ArgumentParser(description='Split a fasta file into several smaller ones with balanced residue counts')
   # Input file
   parser.add_argument('-i', '--input', required=True, help='Fasta file to be split')
   parser.add_argument('-o', '--output', required=True, help='Output directory')
-  parser.add_argument('-n', '--number', required=True, help='Number of files to generate')
+  parser.add_argument('-n', '--number', type=int, help='Number of files to generate, the most to generate with --target-seconds')
+  # Cost model
+  parser.add_argument('--plan', help='Plan file to write (default: <output>/<input>.plan)')
+  parser.add_argument('--tool', action='append', type=tool_option, default=list(), help='Tool run on the shards, as ID or ID:DATABASE_SIZE (repeatable)')
+  parser.add_argument('--history', nargs='+', default=list(), help='Logs directories of earlier runs to fit the cost model of every tool from')
+  parser.add_argument('--target-seconds', type=float, help='Wall time every shard should finish in, picks the number of files')
   options = parser.parse_args(args)
 
-  inputFile = open(options.input)
-  sequenceList = deque()
-  current_entry = ""
-  for line in inputFile:
-    if(line.startswith(">")):
-      if(current_entry != ""):
-        sequenceList.append([current_entry.get_length(), current_entry.print_all()])
-      current_entry = sequence(line)
-    else:
-      current_entry.add_line(line)
+  if(options.number == None and options.target_seconds == None):
+    parser.error('one of -n/--number or --target-seconds is required')
+  if(options.target_seconds != None and not (options.tool and options.history)):
+    parser.error('--target-seconds needs --tool and --history to fit the cost model')
 
-  #sequenceList = deque(sorted(sequenceList))
+  records = scan(options.input)
 
-  print "Number of sequences: " + str(len(sequenceList))
+  print "Number of sequences: " + str(len(records))
 
-  fileList = list()
-  for i in range(0, int(options.number)):
-    fileList.append([])
+  basename = os.path.basename(options.input)
+  planPath = options.plan or options.output + "/" + basename + ".plan"
 
-  while(sequenceList):
-    for i in range(0,int(options.number)):
-      if(len(sequenceList) > 1):
-        fileList[i].append(sequenceList.pop()[1])
-        fileList[i].append(sequenceList.popleft()[1])
-      elif len(sequenceList) == 1:
-        fileList[i].append(sequenceList.pop()[1])
-        break
-      else:
-        break
+  models = list()
+  for tool, db_size in options.tool:
+    if(options.history):
+      try:
+        models.append(fit(tool, db_size, options.history, os.path.basename(planPath)))
+      except ValueError, e:
+        parser.error(str(e))
+      print "Cost model of " + tool + ": %.1f + %.6g * residues * %g seconds from %d shards" % (models[-1].overhead, models[-1].rate, db_size, models[-1].points)
+
+  number = options.number
+  if(options.target_seconds != None):
+    limit = min(number or len(records), len(records)) or 1
+    assignment, totals = plan_shards(records, models, options.target_seconds, limit)
+    print "Shards to finish in " + str(options.target_seconds) + " seconds: " + str(len(assignment))
+    if(predict(models, max(totals)) > options.target_seconds):
+      print "Warning: the largest shard is predicted to take " + "%.1f" % predict(models, max(totals)) + " seconds"
+    # Keep writing -n files so a task array of that size finds all its inputs
+    number = max(number or 0, len(assignment))
+    assignment += [list() for i in range(len(assignment), number)]
+    totals += [0] * (number - len(totals))
+  else:
+    assignment, totals = pack(records, number)
 
   if not os.path.isdir(options.output):
     os.makedirs(options.output)
 
-  for i in range(0,int(options.number)):
-    outFile = open(options.output + "/" + os.path.basename(options.input) + "." + str(i+1), "w")
-    print "Number of sequences for file " + str(i) + " = " + str(len(fileList[i]))
-    for item in fileList[i]:
-      outFile.write(item)
+  files = list()
+  inputFile = open(options.input, "rb")
+  for i in range(0, number):
+    files.append(options.output + "/" + basename + "." + str(i+1))
+    outFile = open(files[i], "wb")
+    print "Number of sequences for file " + str(i) + " = " + str(len(assignment[i])) + ", residues = " + str(totals[i])
+    copy_ranges(inputFile, outFile, assignment[i])
+    outFile.close()
+  inputFile.close()
+
+  planDir = os.path.dirname(planPath)
+  if(planDir and not os.path.isdir(planDir)):
+    os.makedirs(planDir)
+  write_plan(planPath, options.input, files, assignment, totals, options.tool, models, options.target_seconds)
+
+  totals = [total for total in totals if total > 0]
+  if(totals):
+    mean = sum(totals) / float(len(totals))
+    print "Largest shard is " + "%.3f" % (max(totals) / mean) + " times the mean of " + str(int(mean)) + " residues"
 
 if __name__ == "__main__":
   main(sys.argv[1:])
@@ -51,6 +51,10 @@ o:  Output generator of choice
 
 r: Just annotator is run on old working directory
 
+x: Wall time in seconds every BLAST/InterPro shard should finish in. The number of shards is then picked by a cost model fitted on earlier runs, with -q as the most shards.
+
+H: Logs directories of earlier runs started with -P to fit the cost model from, separated by ','. Needed with -x.
+
 q: Parameter string for queuing system starting either with 'sge' or 'pbs'. Parameter are seperated by ",".
 
     Example for running GePan SGE: 'sge:walltime=00:60:00,cpu....'
@@ -91,7 +95,7 @@ sub _main{
 
      # get command-line parameter
     our %opts;
-    getopts("b:d:w:f:p:t:c:T:S:q:r:o:s:PRG:g:",\%opts);
+    getopts("b:d:w:f:p:t:c:T:S:q:r:o:s:PRG:g:x:H:",\%opts);
 
     my $params = {work_dir => $opts{'w'},
                   fasta => $opts{'f'},
@@ -108,7 +112,9 @@ sub _main{
                   performance=>$opts{'P'},
                   submit_shells=>$opts{'R'},
                   gestore=>$opts{'G'},
-                  guid=>$opts{'g'}
+                  guid=>$opts{'g'},
+                  target_seconds=>$opts{'x'},
+                  history=>$opts{'H'}
     };
 
     if($params->{'gestore'}) {
@@ -432,6 +438,13 @@ sub _printArrayShell{
     $toolParams->{'output_dir'} = NODE_LOCAL_PATH.'/gepan/${JOB_ID}'.'_'.'${SGE_TASK_ID}/output';
     $toolParams->{'input_file'} = NODE_LOCAL_PATH.'/gepan/${JOB_ID}'.'_'.'${SGE_TASK_ID}/input/exporter.fas.$SGE_TASK_ID';
 
+    # Shards past the ones planned by newScheduler.py are empty, their tasks
+    # only leave empty result files. Priam keeps its results in a directory
+    # layout of its own and still runs on them.
+    my $skipEmpty = !($config->{'id'} eq 'priam' || $config->{'id'} eq 'priama');
+    my @outputFiles;
+    print IN "\nif [ -s ".$toolParams->{'input_file'}." ]\nthen\n" if $skipEmpty;
+
     print IN "\n# execute statement(s) of tool\n";
 
     # get databases annotation tools run on
@@ -457,6 +470,7 @@ sub _printArrayShell{
 	while(my $db_config = $dbs->getNextElement()){
             $toolParams->{'database'} = $db_config;
             $toolParams->{'output_file'} = 'exporter.fas.'.$db_config->getID().'.'.$config->getID().'.out.$SGE_TASK_ID';
+            push @outputFiles, $toolParams->{'output_dir'}.'/'.$toolParams->{'output_file'};
             $toolParams->{'run'} = $params->{'script_id'};
             $toolParams->{'regex'} = $params->{'gestore'};
  #           if($params->{'gestore'}) {
@@ -475,12 +489,20 @@ sub _printArrayShell{
     }
     else{
 	$toolParams->{'output_file'} = 'exporter.fas.'.$config->getID().'.out.$SGE_TASK_ID';
+	push @outputFiles, $toolParams->{'output_dir'}.'/'.$toolParams->{'output_file'};
 	eval{
             _initializeTool($toolClass,$toolParams,*IN,$queueing);
         };
         $params->{'logger'}->LogError("startGePan::_printSingleShellCall() - $@") if ($@);
     }
 
+    if($skipEmpty){
+        print IN "else\n";
+        print IN "\techo \"Shard \${SGE_TASK_ID} is empty, skipping ".$config->getID()."\"\n";
+        print IN "\ttouch $_\n" foreach (@outputFiles);
+        print IN "fi\n";
+    }
+
     print "Input format GS: ".$config->getGsInputFormat()."\n";
     print "Output format GS: ".$config->getGsOutputFormat()."\n";
 
@@ -859,6 +881,30 @@ sub _printExporterShellCall{
 
 
 
+=head2 B<_schedulerModelOptions($params,sequence_type)>
+
+Returns the cost model options of newScheduler.py for the shards of given sequence type: the target wall time, the logs directories of earlier runs and every array tool run on these shards. Empty without a target or without tools.
+
+=cut
+
+sub _schedulerModelOptions{
+    my ($params,$type) = @_;
+
+    return "" unless $params->{'target_seconds'};
+
+    my $pipeline = $params->{'pipeline'};
+    my $tools = "";
+    for(my $i = 1;$i<scalar(@$pipeline);$i++){
+        foreach my $config (@{$pipeline->[$i]}){
+            $tools .= " --tool ".$config->getID() if ($config->getInputType() eq $type);
+        }
+    }
+    return "" unless $tools;
+
+    return " --target-seconds ".$params->{'target_seconds'}." --history ".join(" ",split(",",$params->{'history'})).$tools;
+}
+
+
 =head2 B<_printSchedulerShell($params)>
 
 Print header for filescheduler to split the cds-fasta into several.
@@ -908,7 +954,7 @@ sub _printSchedulerShell{
 
     # print execute statement
     #my $statement = PERL_PATH.' -I '.GEPAN_PATH.' '.GEPAN_PATH.'/GePan/scripts/runScheduler.pl -i '.NODE_LOCAL_PATH.'/gepan/$JOB_ID/input/exporter.fas -o '.NODE_LOCAL_PATH.'/gepan/$JOB_ID/output -n '.$params->{'queueing'}.' -s '.$params->{'sorting'}."\n";
-    my $statement = PYTHON_PATH." ".GEPAN_PATH.'/GePan/scripts/newScheduler.py -i '.NODE_LOCAL_PATH.'/gepan/$JOB_ID/input/exporter.fas -o '.NODE_LOCAL_PATH.'/gepan/$JOB_ID/output -n'.$params->{'queueing'}."\n";
+    my $statement = PYTHON_PATH." ".GEPAN_PATH.'/GePan/scripts/newScheduler.py -i '.NODE_LOCAL_PATH.'/gepan/$JOB_ID/input/exporter.fas -o '.NODE_LOCAL_PATH.'/gepan/$JOB_ID/output -n'.$params->{'queueing'}.' --plan '.$params->{'log_files_dir'}."/nucleotide.plan"._schedulerModelOptions($params,'nucleotide')."\n";
     print IN $statement;
 
     if($params->{'gestore'})
@@ -940,7 +986,7 @@ sub _printSchedulerShell{
 
     # print execute statement
     #my $statement = PERL_PATH.' -I '.GEPAN_PATH.' '.GEPAN_PATH.'/GePan/scripts/runScheduler.pl -i '.NODE_LOCAL_PATH.'/gepan/$JOB_ID/input/exporter.fas -o '.NODE_LOCAL_PATH.'/gepan/$JOB_ID/output -n '.$params->{'queueing'}.' -s '.$params->{'sorting'}."\n";
-    my $statement = PYTHON_PATH." ".GEPAN_PATH.'/GePan/scripts/newScheduler.py -i '.NODE_LOCAL_PATH.'/gepan/$JOB_ID/input/exporter.fas -o '.NODE_LOCAL_PATH.'/gepan/$JOB_ID/output -n'.$params->{'queueing'}."\n";
+    my $statement = PYTHON_PATH." ".GEPAN_PATH.'/GePan/scripts/newScheduler.py -i '.NODE_LOCAL_PATH.'/gepan/$JOB_ID/input/exporter.fas -o '.NODE_LOCAL_PATH.'/gepan/$JOB_ID/output -n'.$params->{'queueing'}.' --plan '.$params->{'log_files_dir'}."/protein.plan"._schedulerModelOptions($params,'protein')."\n";
     print IN $statement;
 
     # copy result protein fastas back
@@ -1257,6 +1303,9 @@ sub _checkScriptParameter{
     elsif(!($params->{'queueing'})){
 	_usage();
     }
+    elsif($params->{'target_seconds'} && !$params->{'history'}){
+	_usage();
+    }
 
 }
 
@@ -1833,6 +1882,8 @@ sub _usage{
     print STDOUT "P : Include performance information in shell scripts (optional)\n";
     print STDOUT "R : Create a script to submit the jobs instead of running them (optional)\n";
     print STDOUT "G : Use GeStore, set taxon (optional)\n";
+    print STDOUT "x : Wall time in seconds per BLAST/InterPro shard, picks the number of shards up to q from earlier runs (optional)\n";
+    print STDOUT "H : Logs directories of earlier runs started with P, separated by \',\', needed with x\n";
     print STDOUT "\n";
     print STDOUT "\n";
     exit;
@@ -1,22 +1,64 @@
 import sqlite3
 import argparse
-from collections import defaultdict, deque
+import heapq
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import textwrap
+from collections import defaultdict, deque, OrderedDict
+
+from common import chunks
+from fasta_index import FastaIndex
 
 SPACE=21
+EMBL_WIDTH=80
+OUTPUT_BUFFER=4 * 1024 * 1024
+SORT_BUFFER=1000000
+LOOKUP_BATCH=500
+LOOKUP_CACHE=100000
+# The UniProt columns used for annotation, out of the 25 stored by create_db.py
+ANNOTATION_COLUMNS=("ID", "AC", "DE", "GN", "OS", "OX", "KW")
 
 class Results:
   def __init__(self):
     pass
 
 
+class InterProHit(object):
+  """One line of InterProScan TSV output with the numeric fields parsed."""
+  __slots__ = ("query_name", "len", "method", "db_entry", "db_member", "start", "end", "evalue", "status", "date", "ipro", "desc", "go")
+
+  def __init__(self, lsplit):
+    self.query_name = lsplit[0]
+    #self.crc64 = lsplit[1]
+    self.len = int(lsplit[2])
+    self.method = lsplit[3]
+    self.db_entry = lsplit[4]
+    self.db_member = lsplit[5]
+    self.start = int(lsplit[6])
+    self.end = int(lsplit[7])
+    # Some member databases do not report an e-value and write "-"
+    self.evalue = float(lsplit[8]) if lsplit[8] != "-" else None
+    self.status = lsplit[9]
+    self.date = lsplit[10]
+    # InterPro columns are only written for matches with an InterPro entry,
+    # GO terms only when run with --goterms
+    if(len(lsplit) > 11):
+      self.ipro = lsplit[11]
+      self.desc = lsplit[12] if len(lsplit) > 12 else None
+    else:
+      self.ipro = None
+      self.desc = None
+    self.go = lsplit[13] if len(lsplit) > 13 else None
+
 class InterProResults(Results):
   def __init__(self, filename):
     self.f = open(filename)
 
   def get_item(self):
-    done = False
-    hit = dict()
-
     l = self.f.readline()
     while(l.startswith("#")):
       l = self.f.readline()
@@ -24,84 +66,224 @@ class InterProResults(Results):
     if(not l):
       return None
 
-    lsplit = l.split("\t")
-
-    hit["query_name"] = lsplit[0]
-    #hit["crc64"] = lsplit[1]
-    hit["len"] = lsplit[2]
-    hit["method"] = lsplit[3]
-    hit["db_entry"] = lsplit[4]
-    hit["db_member"] = lsplit[5]
-    hit["start"] = lsplit[6]
-    hit["end"] = lsplit[7]
-    hit["evalue"] = lsplit[8]
-    hit["status"] = lsplit[9]
-    hit["date"] = lsplit[10]
-    if(len(lsplit) > 11):
-      hit["ipro"] = lsplit[11]
-      hit["desc"] = lsplit[12]
-      hit["go"] = lsplit[13]
-    return hit
+    return InterProHit(l.rstrip("\n").split("\t"))
+
+class BlastHit(object):
+  """One line of tabular BLAST output with the numeric fields parsed."""
+  __slots__ = ("gene_name", "db_name", "percent_id", "hit_length", "mismatches", "gap_openings", "start", "end", "s_start", "s_end", "evalue", "score")
+
+  def __init__(self, lsplit):
+    self.gene_name = lsplit[0]
+    self.db_name = lsplit[1]
+    self.percent_id = float(lsplit[2])
+    self.hit_length = int(lsplit[3])
+    self.mismatches = int(lsplit[4])
+    self.gap_openings = int(lsplit[5])
+    self.start = int(lsplit[6])
+    self.end = int(lsplit[7])
+    self.s_start = int(lsplit[8])
+    self.s_end = int(lsplit[9])
+    self.evalue = float(lsplit[10])
+    self.score = float(lsplit[11])
+
+BLAST_RANKS = {
+  "evalue": lambda hit: (hit.evalue, -hit.score),
+  "score": lambda hit: (-hit.score, hit.evalue),
+}
 
 class BlastResults(Results):
-  def __init__(self, filename):
+  """Reads tabular BLAST output one query at a time.
+
+  BLAST writes the hits of a query on consecutive lines, so only the current
+  query is held in memory. Of each query's hits the best `top` are kept,
+  ranked by e-value or bit score. build_index() writes a sidecar file with
+  the byte range of every query, which fetch() uses to read a single query."""
+  def __init__(self, filename, top=1, rank="evalue"):
+    self.filename = filename
     self.f = open(filename)
-    self.used_names = set()
-
-  def get_item(self):
-    done = False
-
-    hit = dict()
-
-    l = self.f.readline()
-    while(l and l.split("\t")[0] in self.used_names):
-      l = self.f.readline()
-    if(not l):
+    self.top = top
+    self.rank = BLAST_RANKS[rank]
+    self.offset = 0
+    self.line = self.read_line()
+    self.hits = deque()
+    self.index = None
+
+  def read_line(self):
+    line = self.f.readline()
+    self.offset += len(line)
+    while(line and (not line.strip() or line.startswith("#"))):
+      line = self.f.readline()
+      self.offset += len(line)
+    return line
+
+  def select(self, hits):
+    if(self.top):
+      return heapq.nsmallest(self.top, hits, key=self.rank)
+    return sorted(hits, key=self.rank)
+
+  def get_lines(self):
+    if(not self.line):
       return None
+    query = self.line.split("\t", 1)[0]
+    start = self.offset - len(self.line)
+    lines = list()
+    while(self.line and self.line.split("\t", 1)[0] == query):
+      lines.append(self.line)
+      self.line = self.read_line()
+    return (query, start, lines)
+
+  def get_query(self):
+    group = self.get_lines()
+    if(not group):
+      return None
+    query, start, lines = group
+    return (query, self.select(BlastHit(line.rstrip("\n").split("\t")) for line in lines))
 
-    lsplit = l.split("\t")
-
-    hit["gene_name"] = lsplit[0]
-    self.used_names.add(lsplit[0])
-    hit["db_name"] = lsplit[1]
-    hit["percent_id"] = lsplit[2]
-    hit["hit_length"] = lsplit[3]
-    hit["mismatches"] = lsplit[4]
-    hit["gap_openings"] = lsplit[5]
-    hit["start"] = lsplit[6]
-    hit["end"] = lsplit[7]
-    hit["s_start"] = lsplit[8]
-    hit["s_end"] = lsplit[9]
-    hit["evalue"] = lsplit[10]
-    hit["score"] = lsplit[11]
-
-    return hit
+  def get_item(self):
+    while(not self.hits):
+      group = self.get_query()
+      if(not group):
+        return None
+      self.hits.extend(group[1])
+    return self.hits.popleft()
+
+  def index_name(self):
+    return self.filename + ".idx"
+
+  def build_index(self):
+    reader = BlastResults(self.filename)
+    with open(self.index_name(), "w") as f:
+      while True:
+        group = reader.get_lines()
+        if(not group):
+          break
+        query, start, lines = group
+        f.write(query + "\t" + str(start) + "\t" + str(sum(len(line) for line in lines)) + "\n")
+
+  def load_index(self):
+    name = self.index_name()
+    if(not os.path.exists(name) or os.path.getmtime(name) < os.path.getmtime(self.filename)):
+      self.build_index()
+    self.index = dict()
+    for line in open(name):
+      query, start, length = line.rstrip("\n").split("\t")
+      self.index[query] = (int(start), int(length))
+
+  def fetch(self, query):
+    if(self.index == None):
+      self.load_index()
+    if(query not in self.index):
+      return list()
+    start, length = self.index[query]
+    with open(self.filename) as f:
+      f.seek(start)
+      lines = f.read(length).splitlines()
+    return self.select(BlastHit(line.split("\t")) for line in lines if line.strip() and not line.startswith("#"))
+
+class LRUCache:
+  def __init__(self, size):
+    self.size = size
+    self.entries = OrderedDict()
+
+  def __contains__(self, key):
+    return key in self.entries
+
+  def get(self, key):
+    value = self.entries.pop(key)
+    self.entries[key] = value
+    return value
+
+  def put(self, key, value):
+    self.entries.pop(key, None)
+    self.entries[key] = value
+    if(len(self.entries) > self.size):
+      self.entries.popitem(last=False)
+
+def lookup_keys(db_name):
+  """The names a BLAST subject can be found under in create_db.py's accession table.
+
+  Besides the name itself, "sp|P12345|NAME_HUMAN" is looked up by accession
+  and entry name, and "UniRef90_P12345" by accession."""
+  keys = [db_name]
+  if("|" in db_name):
+    keys.extend(part for part in db_name.split("|")[1:] if part)
+  elif(db_name.startswith("UniRef") and "_" in db_name):
+    keys.append(db_name.split("_", 1)[1])
+  return keys
+
+def annotation_value(value):
+  """A UniProt field as a single line.
+
+  The database keeps each field as its flat file lines without the line
+  code, "  RecName: Full=...;\n  AltName: ...\n", so the lines are joined
+  and runs of whitespace collapsed."""
+  if(value == None):
+    return None
+  return " ".join(str(value).split())
 
 class BlastDB:
-  def __init__(self):
+  """Looks up UniProt entries in one or more databases created by create_db.py.
+
+  A BLAST subject is resolved by entry name or by any of its accessions
+  through the accession table. Entries are resolved in batches with chunked
+  IN queries and kept in an LRU cache shared by all databases. A database
+  added earlier takes precedence, and IDs missing from every database are
+  cached as well."""
+  def __init__(self, cache_size=LOOKUP_CACHE):
     self.cons = list()
-
-  def add_db(self, filename):
-    self.cons.append(sqlite3.connect(filename))
+    self.cache = LRUCache(cache_size)
+
+  def add_db(self, filename, read_only=False):
+    con = sqlite3.connect(filename)
+    # Plain strings, the writers write bytes
+    con.text_factory = str
+    if(read_only):
+      con.execute("PRAGMA query_only = ON")
+    tables = set(row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+    # Databases in create_db.py's slim schema keep these columns in the annotation table
+    table = "annotation" if "annotation" in tables else "db"
+    columns = ", ".join(table + "." + column for column in ANNOTATION_COLUMNS)
+    if("accession" in tables):
+      query = "SELECT accession.KEY, " + columns + " FROM accession JOIN " + table + " ON " + table + ".ID = accession.ID WHERE accession.KEY IN "
+    else:
+      # Databases created before accessions were indexed can only be searched by ID
+      query = "SELECT " + table + ".ID, " + columns + " FROM " + table + " WHERE ID IN "
+    self.cons.append((con, query, "accession" in tables))
+
+  def prefetch(self, seq_ids):
+    missing = set(seq_id for seq_id in seq_ids if seq_id not in self.cache)
+    for con, query, by_accession in self.cons:
+      if(not missing):
+        break
+      keys = defaultdict(list)
+      for seq_id in missing:
+        for key in (lookup_keys(seq_id) if by_accession else [seq_id]):
+          keys[key].append(seq_id)
+      c = con.cursor()
+      for chunk in chunks(list(keys)):
+        c.execute(query + "(" + ",".join("?" * len(chunk)) + ")", chunk)
+        for row in c:
+          for seq_id in keys[row[0]]:
+            if(seq_id in missing):
+              self.cache.put(seq_id, tuple(annotation_value(value) for value in row[1:]))
+              missing.discard(seq_id)
+    for seq_id in missing:
+      self.cache.put(seq_id, None)
 
   def get_annotation(self, seq_id):
-    for element in self.cons:
-      c = element.cursor()
-      c.execute('SELECT * from db WHERE ID=?', (seq_id,))
-      element.commit()
-      res = c.fetchone()
-      if(res != None):
-        print "DB QUERY" + str(res)
+    if(seq_id not in self.cache):
+      self.prefetch([seq_id])
+    return self.cache.get(seq_id)
 
 class MgaResults(Results):
   def __init__(self, filename, contigs):
     self.f = open(filename)
     self.contigs = contigs
 
-  def get_item(self):
+  def get_block(self):
     source = self.f.readline()[2:].strip().split(" ")[0]
     if(not source):
-      return False
+      return None
     extra = self.f.readline()[2:].strip()
     extra2 = self.f.readline()[2:].strip()
     genes = list()
@@ -115,6 +297,13 @@ class MgaResults(Results):
         break
       else:
         genes.append(tempLine)
+    return (source, genes)
+
+  def get_item(self):
+    block = self.get_block()
+    if(not block):
+      return False
+    source, genes = block
     for element in genes:
       pred = Prediction(source, element)
       self.contigs[source].predicted[pred.name] = pred
@@ -122,28 +311,67 @@ class MgaResults(Results):
    
 
 class InputResults(Results):
-  def __init__(self, filename):
-    self.f = open(filename)
+  """Reads the contigs of a FASTA file in file order through its .fai index."""
+  def __init__(self, index):
+    self.index = index
+    self.names = iter(self.index.names)
 
   def get_item(self):
-    id_s = self.f.readline().split(" ")[0]
-    if(not id_s):
+    name = next(self.names, None)
+    if(name == None):
       return None
-    seq = ""
-    while True:
-      position = self.f.tell()
-      tempLine = self.f.readline()
-      if(not tempLine):
-        return Contig(id_s, seq)
-      if(not tempLine.startswith(">")):
-        seq = seq + tempLine
+    return Contig(name, self.index.fetch(name))
+
+class Domain(object):
+  """The InterProScan hits of a prediction against one signature and InterPro entry.
+
+  Hits are folded in as they are read: overlapping and adjacent regions are
+  merged, the best e-value is kept and GO terms are collected once each."""
+  __slots__ = ("method", "db_entry", "ipro", "regions", "evalue", "go", "hits")
+
+  def __init__(self, hit):
+    self.method = intern(hit.method)
+    self.db_entry = intern(hit.db_entry)
+    self.ipro = intern(hit.ipro) if hit.ipro and hit.ipro != "-" else None
+    self.regions = list()
+    self.evalue = None
+    self.go = ()
+    self.hits = 0
+    self.add(hit)
+
+  def add(self, hit):
+    self.hits += 1
+    if(hit.evalue != None and (self.evalue == None or hit.evalue < self.evalue)):
+      self.evalue = hit.evalue
+    if(hit.go and hit.go != "-"):
+      if(not self.go):
+        self.go = set()
+      self.go.update(intern(term) for term in hit.go.split("|") if term)
+    self.add_region(hit.start, hit.end)
+
+  def add_region(self, start, end):
+    regions = list()
+    for region in self.regions:
+      if(region[1] + 1 < start or end + 1 < region[0]):
+        regions.append(region)
       else:
-        self.f.seek(position)
-        return Contig(id_s,seq)
+        start = min(start, region[0])
+        end = max(end, region[1])
+    regions.append((start, end))
+    regions.sort()
+    self.regions = regions
+
+  def coverage(self):
+    return sum(end - start + 1 for start, end in self.regions)
+
+  def sort_key(self):
+    return (self.evalue == None, self.evalue, self.method, self.db_entry)
+
+class Contig(object):
+  __slots__ = ("id", "seq", "predicted", "db")
 
-class Contig:
   def __init__(self, id, seq):
-    self.id = id[1:].strip()
+    self.id = id
     self.seq = seq
     self.predicted = dict()
     self.db = None
@@ -151,71 +379,269 @@ class Contig:
   def add_db(self, db):
     self.db = db
 
-  def print_contig(self):
-    output = list()
-    output.extend(self.print_fh())
-    output.extend(self.print_source())
-    output.extend(self.print_cds())
-    output.extend(self.print_seq())
-    for line in output:
-      print line
-
-  def print_fh(self):
-    lines = list()
-    lines.append("FH   Key".ljust(SPACE) + "Location/Qualifiers")
-    lines.append("FH".ljust(SPACE))
-    return lines
-
-  def print_source(self):
-    lines = list()
-    lines.append("FT   source".ljust(SPACE) + "1.." + str(len(self.seq)))
-    lines.append("FT".ljust(SPACE) + "/origid=\"" + self.id + "\"")
-    return lines
-
-  def print_cds(self):
-    lines = list()
-    for pred in self.predicted:
-      lines.append("FT   CDS".ljust(SPACE))
-      lines.append("FT".ljust(SPACE) + "/locus_tag=\"" + self.predicted[pred].name + "\"")
-      if( len(self.predicted[pred].blast_hits) == 0):
-        lines.append("FT".ljust(SPACE) + "No BLAST Annotation")
-      for hit in sorted(self.predicted[pred].blast_hits, key=lambda d: float(d["evalue"])):
-        lines.append("FT".ljust(SPACE) + "/blast_hit=\"" + "complete_name: " + hit["db_name"] + " ID:\"" + hit["gene_name"] + "\"")
-        self.db.get_annotation(hit["db_name"])
-        break
-
-      if( len(self.predicted[pred].pfam_hits) == 0):
-        lines.append("FT".ljust(SPACE) + "No PFAM Annotation")
+  def annotation_ids(self):
+    ids = list()
+    for pred in self.predicted.values():
+      hit = pred.best_blast_hit()
+      if(hit):
+        ids.append(hit.db_name)
+    return ids
+
+  def predictions(self):
+    """The predictions in the order of their position on the contig."""
+    return sorted(self.predicted.values(), key=lambda pred: (pred.start, pred.name))
+
+def quote(value):
+  return "\"" + str(value).replace("\"", "\"\"") + "\""
+
+class Writer(object):
+  """Base class of the output formats.
+
+  A writer formats contigs to text without touching its file, so worker
+  processes can format batches that the main process writes out in order."""
+  extension = None
+
+  def __init__(self, filename=None, buffer_size=OUTPUT_BUFFER):
+    self.f = None
+    if(filename == "-"):
+      self.f = os.fdopen(os.dup(sys.stdout.fileno()), "w", buffer_size)
+    elif(filename):
+      self.f = open(filename, "w", buffer_size)
+    if(self.f):
+      self.f.write(self.header())
+
+  def header(self):
+    return ""
+
+  def format_contig(self, contig):
+    raise NotImplementedError
+
+  def format_contigs(self, contigs):
+    return "".join(self.format_contig(contig) for contig in contigs)
+
+  def write(self, text):
+    self.f.write(text)
+
+  def close(self):
+    self.f.close()
+
+class EmblWriter(Writer):
+  """EMBL flat file entries with qualifiers wrapped at 80 columns and the sequence in blocks of ten."""
+  extension = "embl"
+
+  def feature(self, key, location):
+    return "FT   " + key.ljust(SPACE - 5) + location + "\n"
+
+  def qualifier(self, name, value=None):
+    text = "/" + name if value == None else "/" + name + "=" + quote(str(value).replace("\n", " "))
+    lines = textwrap.wrap(text, EMBL_WIDTH - SPACE, break_on_hyphens=False)
+    return "".join("FT".ljust(SPACE) + line + "\n" for line in lines)
+
+  def format_contig(self, contig):
+    out = list()
+    out.append("ID   " + contig.id + "; ; ; ; ; " + str(len(contig.seq)) + " BP.\nXX\n")
+    out.append("FH   Key".ljust(SPACE) + "Location/Qualifiers\nFH\n")
+    out.append(self.feature("source", "1.." + str(len(contig.seq))))
+    out.append(self.qualifier("origid", contig.id))
+    for pred in contig.predictions():
+      location = str(pred.start) + ".." + str(pred.stop)
+      if(pred.strand == "-"):
+        location = "complement(" + location + ")"
+      out.append(self.feature("CDS", location))
+      out.append(self.qualifier("locus_tag", pred.name))
+      if(pred.frame):
+        out.append(self.qualifier("codon_start", pred.frame + 1))
+      hit = pred.best_blast_hit()
+      if(not hit):
+        out.append(self.qualifier("note", "No BLAST Annotation"))
       else:
-        hit = self.predicted[pred].pfam_hits[0]
-        lines.append("FT".ljust(SPACE) + "/pfam_hit=\"" + "complete_name: " + hit["query_name"])
-    return lines
-
-  def print_seq(self):
-    lines = list()
-    lines.append("SQ   Sequence " + str(len(self.seq)) + " BP;")
-    lines.append(self.seq)
-    return lines
-      
+        out.append(self.qualifier("blast_hit", "complete_name: " + hit.db_name + " evalue: " + str(hit.evalue) + " score: " + str(hit.score)))
+        res = contig.db.get_annotation(hit.db_name)
+        if(res != None):
+          for column, value in zip(ANNOTATION_COLUMNS, res):
+            if(value):
+              out.append(self.qualifier("uniprot_" + column.lower(), value))
+      if(not pred.domains):
+        out.append(self.qualifier("note", "No PFAM Annotation"))
+      else:
+        for domain in pred.domain_list():
+          out.append(self.qualifier("inference", "protein motif:" + domain.method + ":" + domain.db_entry))
+          regions = ",".join(str(start) + ".." + str(end) for start, end in domain.regions)
+          out.append(self.qualifier("note", domain.method + " " + domain.db_entry + " " + regions + " evalue: " + str(domain.evalue)))
+        for ipro in pred.interpro_ids():
+          out.append(self.qualifier("db_xref", "InterPro:" + ipro))
+        for term in pred.go_terms():
+          out.append(self.qualifier("db_xref", term))
+    out.append(self.format_seq(contig.seq))
+    out.append("//\n")
+    return "".join(out)
+
+  def format_seq(self, seq):
+    out = ["SQ   Sequence " + str(len(seq)) + " BP;\n"]
+    for i in range(0, len(seq), 60):
+      line = seq[i:i + 60].lower()
+      blocks = " ".join(line[j:j + 10] for j in range(0, len(line), 10))
+      out.append("     " + blocks.ljust(66) + str(min(i + 60, len(seq))).rjust(9) + "\n")
+    return "".join(out)
+
+# Characters with a meaning in GFF3 column 9
+GFF_ESCAPES = dict((c, "%%%02X" % ord(c)) for c in "%;=&,\t\n\r")
+
+def gff_escape(value):
+  return "".join(GFF_ESCAPES.get(c, c) for c in str(value))
+
+def gff_value(value):
+  """Lists become multiple values separated by commas."""
+  if(isinstance(value, list)):
+    return ",".join(gff_escape(item) for item in value)
+  return gff_escape(value)
+
+class Gff3Writer(Writer):
+  """GFF3 with one CDS line per prediction, the sequences are left in the FASTA file."""
+  extension = "gff3"
+
+  def header(self):
+    return "##gff-version 3\n"
+
+  def format_contig(self, contig):
+    out = ["##sequence-region " + contig.id + " 1 " + str(len(contig.seq)) + "\n"]
+    for pred in contig.predictions():
+      attributes = [("ID", pred.name), ("locus_tag", pred.name)]
+      hit = pred.best_blast_hit()
+      if(hit):
+        attributes.append(("blast_hit", hit.db_name))
+        attributes.append(("blast_evalue", hit.evalue))
+        res = contig.db.get_annotation(hit.db_name)
+        if(res != None):
+          for column, value in zip(ANNOTATION_COLUMNS, res):
+            if(value):
+              attributes.append(("uniprot_" + column.lower(), value))
+      domains = pred.domain_list()
+      if(domains):
+        xrefs = [domain.method + ":" + domain.db_entry for domain in domains] + ["InterPro:" + ipro for ipro in pred.interpro_ids()]
+        attributes.append(("Dbxref", xrefs))
+      go = pred.go_terms()
+      if(go):
+        attributes.append(("Ontology_term", go))
+      columns = (contig.id, "MGA", "CDS", str(pred.start), str(pred.stop), ".", pred.strand, str(pred.frame))
+      out.append("\t".join(columns) + "\t" + ";".join(name + "=" + gff_value(value) for name, value in attributes) + "\n")
+    return "".join(out)
+
+class TsvWriter(Writer):
+  """One tab-separated row per prediction."""
+  extension = "tsv"
+  columns = ("contig", "prediction", "start", "stop", "strand", "blast_hit", "evalue", "score") + ANNOTATION_COLUMNS + ("domains", "interpro", "go")
+
+  def header(self):
+    return "#" + "\t".join(self.columns) + "\n"
+
+  def format_contig(self, contig):
+    out = list()
+    for pred in contig.predictions():
+      row = [contig.id, pred.name, str(pred.start), str(pred.stop), pred.strand]
+      hit = pred.best_blast_hit()
+      res = contig.db.get_annotation(hit.db_name) if hit else None
+      row.extend((hit.db_name, str(hit.evalue), str(hit.score)) if hit else ("", "", ""))
+      row.extend(value or "" for value in (res or ("",) * len(ANNOTATION_COLUMNS)))
+      row.append(",".join(domain.method + ":" + domain.db_entry for domain in pred.domain_list()))
+      row.append(",".join(pred.interpro_ids()))
+      row.append(",".join(pred.go_terms()))
+      out.append("\t".join(row) + "\n")
+    return "".join(out)
+
+class JsonWriter(Writer):
+  """One JSON object per contig and line."""
+  extension = "jsonl"
+
+  def format_contig(self, contig):
+    predictions = list()
+    for pred in contig.predictions():
+      record = {"name": pred.name, "start": pred.start, "stop": pred.stop, "strand": pred.strand, "frame": pred.frame}
+      hit = pred.best_blast_hit()
+      if(hit):
+        record["blast"] = {"hit": hit.db_name, "evalue": hit.evalue, "score": hit.score, "percent_id": hit.percent_id}
+        res = contig.db.get_annotation(hit.db_name)
+        if(res != None):
+          record["uniprot"] = dict(zip(ANNOTATION_COLUMNS, res))
+      if(pred.domains):
+        record["domains"] = [{"method": domain.method, "entry": domain.db_entry, "ipr": domain.ipro, "regions": domain.regions, "coverage": domain.coverage(), "evalue": domain.evalue, "go": sorted(domain.go), "hits": domain.hits} for domain in pred.domain_list()]
+      predictions.append(record)
+    return json.dumps({"id": contig.id, "length": len(contig.seq), "predictions": predictions}) + "\n"
+
+WRITERS = dict((writer.extension, writer) for writer in (EmblWriter, Gff3Writer, TsvWriter, JsonWriter))
+
+class Prediction(object):
+  """A gene predicted by MGA.
+
+  Most predictions have few or no hits, so the hit containers are only
+  created when the first hit is added. InterProScan hits are aggregated
+  into one Domain per signature and InterPro entry."""
+  __slots__ = ("name", "start", "stop", "strand", "frame", "blast_hits", "domains")
+  # How BLAST hits are ranked (a key of BLAST_RANKS), set from --blast-rank
+  blast_rank = "evalue"
 
-class Prediction:
   def __init__(self, name, line):
     splitLine = line.split()
     self.name = name.split(" ")[0] + "_" + splitLine[0]
-    self.start = splitLine[1]
-    self.stop = splitLine[2]
-    self.blast_hits = list()
-    self.pfam_hits = list()
+    self.start = int(splitLine[1])
+    self.stop = int(splitLine[2])
+    self.strand = splitLine[3]
+    self.frame = int(splitLine[4])
+    self.blast_hits = ()
+    self.domains = ()
+
+  def add_blast_hit(self, hit):
+    if(self.blast_hits):
+      self.blast_hits.append(hit)
+    else:
+      self.blast_hits = [hit]
+
+  def add_pfam_hit(self, hit):
+    if(not self.domains):
+      self.domains = dict()
+    key = (hit.method, hit.db_entry, hit.ipro)
+    domain = self.domains.get(key)
+    if(domain == None):
+      self.domains[key] = Domain(hit)
+    else:
+      domain.add(hit)
+
+  def domain_list(self):
+    """The domains, best e-value first."""
+    return sorted(self.domains.values(), key=Domain.sort_key) if self.domains else []
+
+  def interpro_ids(self):
+    return sorted(set(domain.ipro for domain in self.domains.values() if domain.ipro)) if self.domains else []
 
-def add_blast_results(filename, contigs):
-  br = BlastResults(filename)
+  def go_terms(self):
+    terms = set()
+    for domain in (self.domains.values() if self.domains else ()):
+      terms.update(domain.go)
+    return sorted(terms)
+
+  def best_blast_hit(self):
+    if(not self.blast_hits):
+      return None
+    return min(self.blast_hits, key=BLAST_RANKS[self.blast_rank])
+
+def format_contigs(contigs, db, writers):
+  """Formats a batch of contigs for every writer after resolving all of their UniProt IDs at once."""
+  ids = list()
+  for contig in contigs:
+    ids.extend(contig.annotation_ids())
+    contig.add_db(db)
+  db.prefetch(ids)
+  return [writer.format_contigs(contigs) for writer in writers]
+
+def add_blast_results(filename, contigs, top=1, rank="evalue"):
+  br = BlastResults(filename, top, rank)
   while True:
     hit = br.get_item()
     if(not hit):
       break
-    contig_name = hit["gene_name"].split("_")[0]
-    prediction_name = hit["gene_name"]
-    contigs[contig_name].predicted[prediction_name].blast_hits.append(hit)
+    contig_name = hit.gene_name.split("_")[0]
+    prediction_name = hit.gene_name
+    contigs[contig_name].predicted[prediction_name].add_blast_hit(hit)
 
 def add_interpro_results(filename, contigs):
   pf = InterProResults(filename)
@@ -223,37 +649,145 @@ def add_interpro_results(filename, contigs):
     hit = pf.get_item()
     if(not hit):
       break
-    contig_name = hit["query_name"].split("_")[0]
-    prediction_name = hit["query_name"]
-    contigs[contig_name].predicted[prediction_name].pfam_hits.append(hit)
-
-if __name__ == "__main__":
-  parser = argparse.ArgumentParser(description="Create SQLite DBs from UniProt databases")
-
-  parser.add_argument("-f", "--fasta", dest="contig", help="Contigs")
-  parser.add_argument("-g", "--predicted", dest="pred", help="Predicted genes")
-  parser.add_argument("-b", "--blast", dest="br", nargs='+', help="BLAST results", default=[])
-  parser.add_argument("-s", "--sprot", dest="sprot", help="Sprot DB")
-  parser.add_argument("-t", "--trembl", dest="trembl", help="Trembl DB")
-  parser.add_argument("-i", "--interpro", dest="interpro", nargs='+', help="InterPro results", default=[])
-  parser.add_argument("-o", "--output", dest="output", help="Output filename", default="result")
-
-  args = parser.parse_args()
-
+    contig_name = hit.query_name.split("_")[0]
+    prediction_name = hit.query_name
+    contigs[contig_name].predicted[prediction_name].add_pfam_hit(hit)
+
+def contig_name(name):
+  return name.split("_")[0]
+
+class ContigOrder:
+  """Maps contig ids to their position in the contig FASTA file.
+
+  Sequence offsets grow in file order, so the .fai entries already read
+  for the contigs serve as ranks without a table of their own."""
+  def __init__(self, index):
+    self.index = index
+
+  def rank(self, contig_id):
+    return self.index.entries[contig_id].offset
+
+class ContigStream:
+  """Hands out the consecutive items of a sorted results file one contig at a time."""
+  def __init__(self, next_item, contig_of):
+    self.next_item = next_item
+    self.contig_of = contig_of
+    self.pending = next_item()
+
+  def take(self, contig_id):
+    items = list()
+    while(self.pending and self.contig_of(self.pending) == contig_id):
+      items.append(self.pending)
+      self.pending = self.next_item()
+    return items
+
+def write_run(items, tmpdir):
+  items.sort()
+  fd, path = tempfile.mkstemp(dir=tmpdir, suffix=".run")
+  with os.fdopen(fd, "w") as f:
+    for (rank, group), n, line in items:
+      f.write(str(rank) + "\t" + group + "\t" + str(n) + "\t" + line)
+  return path
+
+def read_run(path):
+  for line in open(path):
+    rank, group, n, rest = line.split("\t", 3)
+    yield ((int(rank), group), int(n), rest)
+
+def external_sort(lines, key_of, tmpdir, buffer_size):
+  """Yields lines ordered by key_of(line), a (rank, group) pair, keeping at most buffer_size lines in memory.
+
+  The line number is part of the sort key, so lines with the same key keep their order."""
+  runs = list()
+  items = list()
+  for n, line in enumerate(lines):
+    items.append((key_of(line), n, line))
+    if(len(items) >= buffer_size):
+      runs.append(write_run(items, tmpdir))
+      items = list()
+  if(items):
+    runs.append(write_run(items, tmpdir))
+  for key, n, line in heapq.merge(*[read_run(path) for path in runs]):
+    yield line
+  for path in runs:
+    os.remove(path)
+
+def is_sorted(ranks):
+  previous = -1
+  for rank in ranks:
+    if(rank < previous):
+      return False
+    previous = rank
+  return True
+
+def is_grouped(keys):
+  """True if the (rank, group) keys come in rank order with every group in one consecutive run."""
+  previous_rank = -1
+  previous_group = None
+  seen = set()
+  for rank, group in keys:
+    if(rank < previous_rank):
+      return False
+    if(rank != previous_rank):
+      seen = set()
+    elif(group != previous_group and group in seen):
+      return False
+    seen.add(group)
+    previous_rank = rank
+    previous_group = group
+  return True
+
+def hit_lines(filename):
+  for line in open(filename):
+    if(line.strip() and not line.startswith("#")):
+      yield line
+
+def sorted_hits(filename, order, tmpdir, buffer_size):
+  """Returns a tabular hit file in contig order with the hits of every query together, sorting it on disk if it is not."""
+  def key_of(line):
+    query = line.split("\t", 1)[0]
+    return (order.rank(contig_name(query)), query)
+  if(is_grouped(key_of(line) for line in hit_lines(filename))):
+    return filename
+  fd, path = tempfile.mkstemp(dir=tmpdir, suffix=".sorted")
+  with os.fdopen(fd, "w") as f:
+    for line in external_sort(hit_lines(filename), key_of, tmpdir, buffer_size):
+      f.write(line)
+  return path
+
+def mga_blocks(filename):
+  mga = MgaResults(filename, None)
+  while True:
+    block = mga.get_block()
+    if(not block):
+      break
+    yield block
+
+def sorted_predictions(filename, order, tmpdir, buffer_size):
+  """Returns an MGA file with the contigs in FASTA order, sorting it on disk if it is not."""
+  if(is_sorted(order.rank(source) for source, genes in mga_blocks(filename))):
+    return filename
+  genes = (source + "\t" + gene + "\n" for source, lines in mga_blocks(filename) for gene in lines)
+  key_of = lambda line: (order.rank(line.split("\t", 1)[0]), "")
+  fd, path = tempfile.mkstemp(dir=tmpdir, suffix=".sorted")
+  with os.fdopen(fd, "w") as f:
+    current = None
+    for line in external_sort(genes, key_of, tmpdir, buffer_size):
+      source, gene = line.split("\t", 1)
+      if(source != current):
+        f.write("# " + source + "\n#\n#\n")
+        current = source
+      f.write(gene)
+  return path
+
+def load_contigs(args):
   contigs = dict()
 
-  contig_file = InputResults(args.contig)
-
-  db = BlastDB()
-  if(args.sprot):
-    db.add_db(args.sprot)
-  if(args.trembl):
-    db.add_db(args.trembl)
+  contig_file = InputResults(FastaIndex(args.contig))
 
   while True:
     contig = contig_file.get_item()
     if(contig):
-      contig.add_db(db)
       contigs[contig.id] = contig
     else:
       break
@@ -265,11 +799,175 @@ if __name__ == "__main__":
       break
   
   for filename in args.br:
-    add_blast_results(filename, contigs)
+    add_blast_results(filename, contigs, args.blast_top, args.blast_rank)
 
   for filename in args.interpro:
     add_interpro_results(filename, contigs)
 
   for con in contigs.keys():
-    contigs[con].print_contig()
-    pass
+    yield contigs[con]
+
+def stream_contigs(args, tmpdir):
+  """Yields each contig as soon as its predictions and hits have been read.
+
+  All inputs are read in contig FASTA order, so only the contigs waiting to
+  be printed are held in memory with their predictions and hits."""
+  index = FastaIndex(args.contig)
+  order = ContigOrder(index)
+  contig_file = InputResults(index)
+
+  mga = MgaResults(sorted_predictions(args.pred, order, tmpdir, args.sort_buffer), None)
+  predictions = ContigStream(mga.get_block, lambda block: block[0])
+
+  blast = list()
+  for filename in args.br:
+    br = BlastResults(sorted_hits(filename, order, tmpdir, args.sort_buffer), args.blast_top, args.blast_rank)
+    blast.append(ContigStream(br.get_item, lambda hit: contig_name(hit.gene_name)))
+
+  interpro = list()
+  for filename in args.interpro:
+    pf = InterProResults(sorted_hits(filename, order, tmpdir, args.sort_buffer))
+    interpro.append(ContigStream(pf.get_item, lambda hit: contig_name(hit.query_name)))
+
+  while True:
+    contig = contig_file.get_item()
+    if(not contig):
+      break
+    for source, genes in predictions.take(contig.id):
+      for element in genes:
+        pred = Prediction(source, element)
+        contig.predicted[pred.name] = pred
+    for stream in blast:
+      for hit in stream.take(contig.id):
+        contig.predicted[hit.gene_name].add_blast_hit(hit)
+    for stream in interpro:
+      for hit in stream.take(contig.id):
+        contig.predicted[hit.query_name].add_pfam_hit(hit)
+    yield contig
+
+def batches(contigs, size):
+  batch = list()
+  for contig in contigs:
+    batch.append(contig)
+    if(len(batch) >= size):
+      yield batch
+      batch = list()
+  if(batch):
+    yield batch
+
+def open_db(sprot, trembl, cache_size, read_only=False):
+  db = BlastDB(cache_size)
+  if(sprot):
+    db.add_db(sprot, read_only)
+  if(trembl):
+    db.add_db(trembl, read_only)
+  return db
+
+def db_release(filename):
+  """Returns the UniProt release recorded by create_db.py, None for databases without one."""
+  con = sqlite3.connect(filename)
+  try:
+    res = con.execute("SELECT value FROM meta WHERE key='release'").fetchone()
+  except sqlite3.OperationalError:
+    res = None
+  con.close()
+  return res[0] if res else None
+
+worker_db = None
+worker_writers = None
+
+def init_worker(sprot, trembl, cache_size, formats, blast_rank):
+  global worker_db, worker_writers
+  Prediction.blast_rank = blast_rank
+  worker_db = open_db(sprot, trembl, cache_size, read_only=True)
+  worker_writers = [WRITERS[name]() for name in formats]
+
+def format_batch(contigs):
+  return format_contigs(contigs, worker_db, worker_writers)
+
+def open_writers(args):
+  """One writer per requested format, writing to <output>.<extension> or to standard output for -o -."""
+  writers = list()
+  for name in args.formats:
+    filename = args.output if args.output == "-" else args.output + "." + WRITERS[name].extension
+    writers.append(WRITERS[name](filename, args.buffer))
+  return writers
+
+def write_all(writers, texts):
+  for writer, text in zip(writers, texts):
+    writer.write(text)
+
+def annotate(contigs, args, writers):
+  db = open_db(args.sprot, args.trembl, args.cache_size)
+  for batch in batches(contigs, args.batch_size):
+    write_all(writers, format_contigs(batch, db, writers))
+
+def annotate_parallel(contigs, args, writers):
+  """Formats batches of contigs in a pool of worker processes.
+
+  Each worker opens its own read-only connections to the UniProt databases.
+  Output is written in input order, and at most two batches per worker are
+  waiting at any time."""
+  pool = multiprocessing.Pool(args.workers, init_worker, (args.sprot, args.trembl, args.cache_size, args.formats, args.blast_rank))
+  pending = deque()
+  try:
+    for batch in batches(contigs, args.batch_size):
+      pending.append(pool.apply_async(format_batch, (batch,)))
+      if(len(pending) >= 2 * args.workers):
+        write_all(writers, pending.popleft().get())
+    while(pending):
+      write_all(writers, pending.popleft().get())
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Create SQLite DBs from UniProt databases")
+
+  parser.add_argument("-f", "--fasta", dest="contig", help="Contigs")
+  parser.add_argument("-g", "--predicted", dest="pred", help="Predicted genes")
+  parser.add_argument("-b", "--blast", dest="br", nargs='+', help="BLAST results", default=[])
+  parser.add_argument("--blast-top", dest="blast_top", type=int, help="Hits kept per query, 0 keeps all", default=1)
+  parser.add_argument("--blast-rank", dest="blast_rank", choices=sorted(BLAST_RANKS), help="Rank BLAST hits by e-value or bit score", default="evalue")
+  parser.add_argument("-s", "--sprot", dest="sprot", help="Sprot DB")
+  parser.add_argument("-t", "--trembl", dest="trembl", help="Trembl DB")
+  parser.add_argument("-r", "--release", dest="release", help="Refuse databases that were not built from this UniProt release")
+  parser.add_argument("-i", "--interpro", dest="interpro", nargs='+', help="InterPro results", default=[])
+  parser.add_argument("-o", "--output", dest="output", help="Output filename, the extension of each format is appended, - writes a single format to standard output", default="result")
+  parser.add_argument("--format", dest="formats", nargs='+', choices=sorted(WRITERS), help="Output formats, all written in one pass", default=["embl"])
+  parser.add_argument("--buffer", dest="buffer", type=int, help="Output buffer size in bytes", default=OUTPUT_BUFFER)
+  parser.add_argument("--streaming", dest="streaming", action="store_true", help="Emit each contig as soon as its inputs are read, sorting unsorted inputs on disk")
+  parser.add_argument("--sort-buffer", dest="sort_buffer", type=int, help="Lines held in memory per on-disk sort run", default=SORT_BUFFER)
+  parser.add_argument("--tmpdir", dest="tmpdir", help="Directory for on-disk sort runs", default=None)
+  parser.add_argument("--batch-size", dest="batch_size", type=int, help="Contigs whose UniProt IDs are looked up together", default=LOOKUP_BATCH)
+  parser.add_argument("--cache-size", dest="cache_size", type=int, help="UniProt entries kept in the lookup cache", default=LOOKUP_CACHE)
+  parser.add_argument("--workers", dest="workers", type=int, help="Annotate batches of contigs in this many processes", default=1)
+
+  args = parser.parse_args()
+
+  if(args.release):
+    for filename in (args.sprot, args.trembl):
+      if(filename and db_release(filename) != args.release):
+        parser.error(filename + " was built from UniProt release " + str(db_release(filename)) + ", not " + args.release)
+
+  if(args.output == "-" and len(args.formats) > 1):
+    parser.error("only one format can be written to standard output")
+
+  Prediction.blast_rank = args.blast_rank
+  tmpdir = tempfile.mkdtemp(dir=args.tmpdir)
+  writers = open_writers(args)
+  try:
+    if(args.streaming):
+      contigs = stream_contigs(args, tmpdir)
+    else:
+      contigs = load_contigs(args)
+
+    if(args.workers > 1):
+      annotate_parallel(contigs, args, writers)
+    else:
+      annotate(contigs, args, writers)
+  finally:
+    for writer in writers:
+      writer.close()
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,174 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import rss_bytes
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+MEMBER_DATABASES = ("Pfam", "Gene3D", "SUPERFAMILY", "SMART", "PROSITE")
+
+def random_seq(alphabet, length):
+  return "".join(random.choice(alphabet) for i in xrange(length))
+
+def write_wrapped(out, seq, width=60):
+  for i in xrange(0, len(seq), width):
+    out.write(seq[i:i + width] + "\n")
+
+def generate_uniprot(path, entries):
+  """A UniProt .dat file with the line types create_db.py stores."""
+  out = open(path, "w")
+  for i in xrange(entries):
+    length = random.randint(50, 600)
+    out.write("ID   PROT%d_HUMAN             Reviewed;         %d AA.\n" % (i, length))
+    out.write("AC   P%06d; Q%06d;\n" % (i, i))
+    out.write("DT   01-JAN-1990, integrated into UniProtKB/Swiss-Prot.\n")
+    out.write("DE   RecName: Full=Synthetic protein %d;\n" % i)
+    out.write("GN   Name=G%d;\n" % i)
+    out.write("OS   Homo sapiens (Human).\nOC   Eukaryota; Metazoa; Chordata.\nOX   NCBI_TaxID=9606;\n")
+    out.write("RN   [1]\nRA   Doe J.;\nRT   \"A synthetic entry.\";\nRL   J. Synth. Biol. 1:1-2(2016).\n")
+    out.write("CC   -!- FUNCTION: Benchmark data.\n")
+    out.write("DR   GO; GO:%07d; F:binding; IEA:InterPro.\n" % (i % 5000))
+    out.write("DR   Pfam; PF%05d; Dom; 1.\nDR   InterPro; IPR%06d; Dom.\n" % (i % 2000, i % 3000))
+    out.write("PE   1: Evidence at protein level;\nKW   Complete proteome; Reference proteome.\n")
+    out.write("FT   CHAIN         1    %d       Synthetic protein %d.\n" % (length, i))
+    out.write("SQ   SEQUENCE   %d AA;  12345 MW;  0123456789ABCDEF CRC64;\n" % length)
+    seq = random_seq(AMINO_ACIDS, length)
+    for j in xrange(0, length, 60):
+      chunk = seq[j:j + 60]
+      out.write("     " + " ".join(chunk[k:k + 10] for k in xrange(0, len(chunk), 10)) + "\n")
+    out.write("//\n")
+  out.close()
+
+def generate_annotation_inputs(directory, contigs, entries, genes, hits):
+  """Contigs, MGA predictions, BLAST tabular output and InterProScan TSV that refer to each other.
+
+  Returns the number of genes predicted."""
+  fasta = open(os.path.join(directory, "contigs.fa"), "w")
+  mga = open(os.path.join(directory, "mga.txt"), "w")
+  blast = open(os.path.join(directory, "blast.tsv"), "w")
+  interpro = open(os.path.join(directory, "interpro.tsv"), "w")
+  total = 0
+  for c in xrange(contigs):
+    name = "contig%d" % c
+    length = random.randint(500, 20000)
+    fasta.write(">" + name + "\n")
+    write_wrapped(fasta, random_seq("ACGT", length))
+    mga.write("# %s\n# gc = 0.5, rbs = -1\n# self: -\n" % name)
+    for g in xrange(random.randint(0, 2 * genes)):
+      start = random.randint(1, length - 100)
+      end = min(length, start + 3 * random.randint(30, 600) - 1)
+      mga.write("gene_%d\t%d\t%d\t%s\t0\t11\t%.1f\t\t\t\t\n" % (g + 1, start, end, random.choice("+-"), random.uniform(10, 500)))
+      gene = "%s_gene_%d" % (name, g + 1)
+      total += 1
+      for h in xrange(random.randint(0, 2 * hits)):
+        subject = random.randint(0, entries - 1)
+        blast.write("%s\tsp|P%06d|PROT%d_HUMAN\t%.2f\t%d\t%d\t%d\t%d\t%d\t%d\t%d\t%.1e\t%.1f\n" % (gene, subject, subject, random.uniform(20, 100), 100, 3, 1, 1, 100, 1, 100, 10 ** -random.randint(1, 80), random.uniform(30, 500)))
+      for h in xrange(random.randint(0, hits)):
+        a = random.randint(1, 200)
+        interpro.write("%s\tCRC\t%d\t%s\tPF%05d\tdomain\t%d\t%d\t%.1e\tT\t04-04-2016\tIPR%06d\tInterPro entry\tGO:%07d|GO:%07d\n" % (gene, end - start + 1, random.choice(MEMBER_DATABASES), random.randint(0, 2000), a, a + random.randint(20, 150), 10 ** -random.randint(1, 30), random.randint(0, 3000), random.randint(0, 5000), random.randint(0, 5000)))
+  for f in (fasta, mga, blast, interpro):
+    f.close()
+  return total
+
+def run(name, command, items, unit):
+  """Runs a command and returns its wall time, peak RSS and throughput."""
+  with open(os.devnull, "w") as devnull:
+    start = time.time()
+    process = subprocess.Popen(command, stdout=devnull)
+    pid, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - start
+  if(status != 0):
+    raise RuntimeError(name + " failed: " + " ".join(command))
+  result = {
+    "name": name,
+    "command": command,
+    "seconds": round(seconds, 3),
+    "max_rss": rss_bytes(usage),
+    "items": items,
+    "unit": unit,
+    "per_second": round(items / max(seconds, 1e-9), 1),
+  }
+  sys.stderr.write("%-16s %8.2f s %8.1f MB %12.1f %s per second\n" % (name, seconds, result["max_rss"] / 2.0 ** 20, result["per_second"], unit))
+  return result
+
+def git_commit():
+  try:
+    with open(os.devnull, "w") as devnull:
+      return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=HERE, stderr=devnull).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def compare(baseline, results):
+  """Prints the change in wall time and peak RSS of every run against an earlier results file."""
+  before = dict((r["name"], r) for r in baseline["runs"])
+  print "Compared to " + str(baseline.get("commit"))
+  for r in results["runs"]:
+    if(r["name"] in before):
+      old = before[r["name"]]
+      print "%-16s time %6.2fx  peak RSS %6.2fx" % (r["name"], r["seconds"] / max(old["seconds"], 1e-9), r["max_rss"] / float(max(old["max_rss"], 1)))
+
+def benchmark(args, directory):
+  python = sys.executable
+  random.seed(args.seed)
+  generate_uniprot(os.path.join(directory, "uniprot.dat"), args.entries)
+  genes = generate_annotation_inputs(directory, args.contigs, args.entries, args.genes, args.hits)
+
+  def path(name):
+    return os.path.join(directory, name)
+  if(os.path.exists(path("sprot.db"))):
+    os.remove(path("sprot.db"))
+  runs = list()
+  runs.append(run("create_db", [python, os.path.join(HERE, "create_db.py"), "-f", path("uniprot.dat"), "-o", path("sprot.db"), "-w", str(args.workers)], args.entries, "entries"))
+  annotate = [python, os.path.join(HERE, "annotate.py"), "-f", path("contigs.fa"), "-g", path("mga.txt"), "-b", path("blast.tsv"), "-i", path("interpro.tsv"), "-s", path("sprot.db"), "--workers", str(args.workers)]
+  runs.append(run("annotate", annotate + ["-o", path("annotated"), "--format", "embl"], args.contigs, "contigs"))
+  runs.append(run("annotate_all", annotate + ["-o", path("annotated"), "--format", "embl", "gff3", "tsv", "jsonl"], args.contigs, "contigs"))
+  runs.append(run("annotate_stream", annotate + ["-o", path("annotated"), "--format", "embl", "--streaming", "--tmpdir", directory], args.contigs, "contigs"))
+  runs.append(run("mga_exporter", [python, os.path.join(HERE, "mga_exporter.py"), "-i", path("contigs.fa"), "-o", path("mga.txt"), "-r", path("genes.fa")], genes, "genes"))
+  runs.append(run("mga_exporter_aa", [python, os.path.join(HERE, "mga_exporter.py"), "-i", path("contigs.fa"), "-o", path("mga.txt"), "-r", path("proteins.fa"), "-p"], genes, "genes"))
+  return runs
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark create_db.py, annotate.py and mga_exporter.py on synthetic data")
+  parser.add_argument("-o", "--output", dest="output", help="JSON file to write the results to", default="bench.json")
+  parser.add_argument("-c", "--contigs", dest="contigs", type=int, help="Contigs to generate", default=10000)
+  parser.add_argument("-e", "--entries", dest="entries", type=int, help="UniProt entries to generate", default=20000)
+  parser.add_argument("--genes", dest="genes", type=int, help="Average genes predicted per contig", default=5)
+  parser.add_argument("--hits", dest="hits", type=int, help="Average BLAST hits and most InterPro hits per gene", default=3)
+  parser.add_argument("-w", "--workers", dest="workers", type=int, help="Workers passed to create_db.py and annotate.py", default=1)
+  parser.add_argument("--seed", dest="seed", type=int, help="Random seed of the generated data", default=1)
+  parser.add_argument("--keep", dest="keep", help="Generate the data in this directory and keep it")
+  parser.add_argument("--compare", dest="compare", help="Earlier results file to compare against")
+
+  args = parser.parse_args()
+
+  directory = args.keep or tempfile.mkdtemp()
+  if(args.keep and not os.path.isdir(directory)):
+    os.makedirs(directory)
+  try:
+    runs = benchmark(args, directory)
+  finally:
+    if(not args.keep):
+      shutil.rmtree(directory)
+
+  results = {
+    "commit": git_commit(),
+    "time": int(time.time()),
+    "python": platform.python_version(),
+    "parameters": {"contigs": args.contigs, "entries": args.entries, "genes": args.genes, "hits": args.hits, "workers": args.workers, "seed": args.seed},
+    "runs": runs,
+  }
+  with open(args.output, "w") as f:
+    json.dump(results, f, indent=1, sort_keys=True)
+
+  if(args.compare):
+    with open(args.compare) as f:
+      compare(json.load(f), results)
@@ -0,0 +1,88 @@
+import argparse
+import random
+import resource
+import subprocess
+import sys
+
+from annotate import BlastHit, InterProHit
+from common import rss_bytes
+
+def blast_line(i):
+  return "contig%d_gene_%d\tsp|P%05d|PROT_HUMAN\t%.2f\t%d\t%d\t%d\t%d\t%d\t%d\t%d\t%.1e\t%.1f" % (i / 5, i % 5, i % 100000, random.uniform(20, 100), random.randint(50, 500), random.randint(0, 50), random.randint(0, 5), 1, 300, 1, 300, 10 ** -random.randint(1, 80), random.uniform(30, 500))
+
+def interpro_line(i):
+  return "contig%d_gene_%d\t0123456789ABCDEF\t%d\tPfam\tPF%05d\tDomain of unknown function\t%d\t%d\t%.1e\tT\t04-04-2016\tIPR%06d\tInterPro entry\tGO:0005524|GO:0016887" % (i / 5, i % 5, random.randint(50, 500), i % 20000, 1, random.randint(20, 300), 10 ** -random.randint(1, 30), i % 30000)
+
+# The dict records annotate.py used before hits were parsed into slotted objects
+def blast_dict(lsplit):
+  hit = dict()
+  hit["gene_name"] = lsplit[0]
+  hit["db_name"] = lsplit[1]
+  hit["percent_id"] = lsplit[2]
+  hit["hit_length"] = lsplit[3]
+  hit["mismatches"] = lsplit[4]
+  hit["gap_openings"] = lsplit[5]
+  hit["start"] = lsplit[6]
+  hit["end"] = lsplit[7]
+  hit["s_start"] = lsplit[8]
+  hit["s_end"] = lsplit[9]
+  hit["evalue"] = lsplit[10]
+  hit["score"] = lsplit[11]
+  return hit
+
+def interpro_dict(lsplit):
+  hit = dict()
+  hit["query_name"] = lsplit[0]
+  hit["len"] = lsplit[2]
+  hit["method"] = lsplit[3]
+  hit["db_entry"] = lsplit[4]
+  hit["db_member"] = lsplit[5]
+  hit["start"] = lsplit[6]
+  hit["end"] = lsplit[7]
+  hit["evalue"] = lsplit[8]
+  hit["status"] = lsplit[9]
+  hit["date"] = lsplit[10]
+  hit["ipro"] = lsplit[11]
+  hit["desc"] = lsplit[12]
+  hit["go"] = lsplit[13]
+  return hit
+
+RECORDS = {
+  ("blast", "dict"): (blast_line, blast_dict),
+  ("blast", "slots"): (blast_line, BlastHit),
+  ("interpro", "dict"): (interpro_line, interpro_dict),
+  ("interpro", "slots"): (interpro_line, InterProHit),
+}
+
+def max_rss():
+  return rss_bytes(resource.getrusage(resource.RUSAGE_SELF))
+
+def measure(kind, representation, hits):
+  """Builds the records in this process and prints the bytes they added to the peak RSS."""
+  make_line, make_record = RECORDS[(kind, representation)]
+  random.seed(1)
+  before = max_rss()
+  records = list()
+  for i in xrange(hits):
+    records.append(make_record(make_line(i).split("\t")))
+  print max_rss() - before
+
+def run(kind, representation, hits):
+  """Measures in a fresh interpreter so earlier runs do not inflate the peak RSS."""
+  output = subprocess.check_output([sys.executable, __file__, "--measure", kind, representation, "-n", str(hits)])
+  return int(output.strip())
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Report the memory used per million hits by the annotate.py hit records")
+  parser.add_argument("-n", "--hits", dest="hits", type=int, help="Hits to build per measurement", default=1000000)
+  parser.add_argument("--measure", dest="measure", nargs=2, help=argparse.SUPPRESS)
+
+  args = parser.parse_args()
+
+  if(args.measure):
+    measure(args.measure[0], args.measure[1], args.hits)
+  else:
+    for kind in ("blast", "interpro"):
+      before = run(kind, "dict", args.hits) * 1000000.0 / args.hits
+      after = run(kind, "slots", args.hits) * 1000000.0 / args.hits
+      print kind.ljust(10) + "dict: %8.1f MB  slots: %8.1f MB  per million hits (%.1fx smaller)" % (before / 2 ** 20, after / 2 ** 20, before / after)
@@ -0,0 +1,14 @@
+"""Helpers shared by the scripts in this directory."""
+
+# SQLite refuses statements with more than 999 host parameters
+MAX_VARIABLES = 999
+
+def chunks(items, size=MAX_VARIABLES):
+  """Consecutive slices of a list, by default small enough for one IN (...) query each."""
+  for i in range(0, len(items), size):
+    yield items[i:i + size]
+
+def rss_bytes(usage):
+  """Peak resident set size of a resource usage, in bytes."""
+  # ru_maxrss is in kilobytes on Linux
+  return usage.ru_maxrss * 1024
@@ -1,20 +1,40 @@
 import sqlite3
 import argparse
 from collections import defaultdict
+import hashlib
+import multiprocessing
+import os
 import time
+import zlib
+
+from common import chunks
+
+FIELDS = ("ID", "AC", "DT", "DE", "GN", "OS", "OG", "OC", "OX", "OH", "RN", "RP", "RC", "RX", "RG", "RA", "RT", "RL", "CC", "DR", "PE", "KW", "FT", "SQ", "SEQ")
+# The slim schema keeps the fields used for annotation in the annotation table
+# and the rest of an entry as one compressed blob in the bulk table
+SLIM_FIELDS = ("ID", "AC", "DE", "GN", "OS", "OX", "KW", "DR")
+BULK_FIELDS = tuple(field for field in FIELDS if field not in SLIM_FIELDS)
+SCHEMAS = ("wide", "slim")
+# DR lines exploded into the xref table
+XREF_DATABASES = ("GO", "Pfam", "InterPro", "KEGG")
+CHUNK_BYTES = 32 * 1024 * 1024
+REPORT_EVERY = 10000
 
 
 class UniProtFile:
-  def __init__(self, filename):
+  def __init__(self, filename, start=0, end=None):
     self.f = open(filename)
-    
+    self.f.seek(start)
+    self.end = end
+
 
   def get_entry(self):
     retVal = defaultdict(str)
-    done = False
-    while(not done):
+    if(self.end != None and self.f.tell() >= self.end):
+      return retVal
+    while(self.end == None or self.f.tell() < self.end):
       line = self.f.readline()
-      if(line.startswith("//") or not line):
+      if(not line or line.rstrip("\r\n") == "//"):
         break
       if(not line.startswith("  ")):
         retVal[line[0:2]] = retVal[line[0:2]] + line[3:]
@@ -22,53 +42,365 @@ class UniProtFile:
         retVal["SEQ"] = retVal["SEQ"] + line[3:]
     return retVal
 
+def split_file(filename, chunk_bytes):
+  """Splits a UniProt file into byte ranges that each end on a // line."""
+  size = os.path.getsize(filename)
+  ranges = list()
+  with open(filename) as f:
+    start = 0
+    while(start < size):
+      if(start + chunk_bytes >= size):
+        end = size
+      else:
+        # The seek may land inside a line, finish that line before looking
+        # for the terminator so no partial line is taken for one
+        f.seek(start + chunk_bytes - 1)
+        f.readline()
+        while True:
+          line = f.readline()
+          if(not line or line.rstrip("\r\n") == "//"):
+            break
+        end = f.tell()
+      ranges.append((filename, start, end))
+      start = end
+  return ranges
+
+def parse_range(task):
+  filename, start, end = task
+  f = UniProtFile(filename, start, end)
+  rows = list()
+  while True:
+    entry = f.get_entry()
+    if(len(entry) < 1):
+      return rows
+    rows.append(tuple(entry[field] for field in FIELDS))
+
+def entry_name(row):
+  return row[0].split()[0]
+
+def primary_accession(row):
+  return row[1].split(";")[0].strip()
+
+def accessions(ac):
+  return [accession.strip() for accession in ac.split(";") if accession.strip()]
+
+def lookup_fields(row):
+  return (row[0], row[1], row[FIELDS.index("DR")])
+
+def accession_rows(id, ac):
+  """Every name an entry can be looked up by: its entry name and all of its accessions."""
+  keys = list()
+  for key in [id.split()[0]] + accessions(ac):
+    if(key not in keys):
+      keys.append(key)
+  return [(key, id) for key in keys]
+
+def xref_rows(id, dr):
+  rows = list()
+  for line in dr.splitlines():
+    parts = [part.strip() for part in line.split(";")]
+    if(len(parts) > 1 and parts[0] in XREF_DATABASES):
+      rows.append((parts[0], parts[1], id))
+  return rows
+
+def row_hash(row):
+  return hashlib.sha1("\0".join(row)).hexdigest()
+
+def hash_row(row):
+  return (entry_name(row), row[0], primary_accession(row), row_hash(row))
+
+def slim_row(row):
+  return tuple(row[FIELDS.index(field)] for field in SLIM_FIELDS)
+
+def bulk_row(row):
+  data = "\0".join(row[FIELDS.index(field)] for field in BULK_FIELDS)
+  return (row[0], sqlite3.Binary(zlib.compress(data)))
+
+def read_entry(con, seq_id):
+  """Returns all fields of an entry as a dict, or None.
+
+  In a slim database the bulky fields are only decompressed here, when
+  they are asked for."""
+  if(db_schema(con) == "wide"):
+    res = con.execute("SELECT " + ", ".join(FIELDS) + " FROM db WHERE ID=?", (seq_id,)).fetchone()
+    return dict(zip(FIELDS, res)) if res else None
+  res = con.execute("SELECT " + ", ".join(SLIM_FIELDS) + " FROM annotation WHERE ID=?", (seq_id,)).fetchone()
+  if(not res):
+    return None
+  entry = dict(zip(SLIM_FIELDS, res))
+  data = con.execute("SELECT data FROM bulk WHERE ID=?", (seq_id,)).fetchone()[0]
+  entry.update(zip(BULK_FIELDS, zlib.decompress(data).split("\0")))
+  return entry
+
+def db_schema(con):
+  if(con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='annotation'").fetchone()):
+    return "slim"
+  return "wide"
+
+class Progress:
+  def __init__(self, every=REPORT_EVERY):
+    self.every = every
+    self.rows = 0
+    self.prev_rows = 0
+    self.start_time = time.time()
+    self.prev_time = self.start_time
+
+  def add(self, rows):
+    self.rows += rows
+    if(self.rows - self.prev_rows >= self.every):
+      cur_time = time.time()
+      IPS = (self.rows - self.prev_rows) / (cur_time - self.prev_time)
+      print "Current entry: " + str(self.rows) + " (" + str(int(IPS)) + " inserts per second)"
+      self.prev_rows = self.rows
+      self.prev_time = cur_time
+
+  def done(self):
+    time_taken = time.time() - self.start_time
+    print "Inserted " + str(self.rows) + " entries in " + str(int(time_taken)) + " seconds (" + str(int(self.rows / max(time_taken, 1e-9))) + " inserts per second)"
+
 class DB:
-  def __init__(self, filename, output):
+  """A SQLite copy of a UniProt file.
+
+  The wide schema stores every field in the db table. The slim schema stores
+  the annotation fields in the annotation table and the other fields
+  compressed in the bulk table.
+
+  The accession table maps the entry name and every accession of an entry
+  to its ID, and the xref table holds its GO, Pfam, InterPro and KEGG
+  cross-references, so lookups on any of them are indexed.
+
+  Next to the entries every entry has a row in hashes, keyed by its entry
+  name, holding a hash of its content so an update only rewrites the entries
+  that changed. The meta table records the release the database was built from."""
+  def __init__(self, filename, output, update=False, schema="wide"):
     self.c = sqlite3.connect(output)
-    self.f = UniProtFile(filename)
-    self.init_db()
+    # Read text back as str, so stored rows hash and compress like parsed ones
+    self.c.text_factory = str
+    self.filename = filename
+    if(update):
+      self.open_db()
+    else:
+      self.init_db(schema)
 
-  def init_db(self):
+  def init_db(self, schema):
     self.c.execute("PRAGMA synchronous = OFF")
     self.c.execute("PRAGMA journal_mode = MEMORY")
-    self.c.execute("CREATE TABLE db (ID text, AC text, DT text, DE text, GN text, OS text, OG text, OC text, OX text, OH text, RN text, RP text, RC text, RX text, RG text, RA text, RT text, RL text, CC text, DR text, PE text, KW text, FT text, SQ text, SEQ text)")
+    self.schema = schema
+    self.create_tables()
+    self.create_lookup_tables()
+    self.c.execute("CREATE TABLE hashes (NAME text, ID text, AC text, HASH text)")
+    self.c.execute("CREATE TABLE meta (key text PRIMARY KEY, value text)")
     self.c.commit()
-  
-  def populate_db(self):
-
-    prev_i = 0
-    prev_time = time.time()
-    done = False
-    i = 0
-    conn = self.c.cursor()
-    while(not done):
-      i += 1
-      entry = self.f.get_entry()
-      if(len(entry) < 1):
-        print("DONE")
-        done = True
-      entry_tuple = (entry["ID"], entry["AC"], entry["DT"], entry["DE"], entry["GN"], entry["OS"], entry["OG"], entry["OC"], entry["OX"], entry["OH"], entry["RN"], entry["RP"], entry["RC"], entry["RX"], entry["RG"], entry["RA"], entry["RT"], entry["RL"], entry["CC"], entry["DR"], entry["PE"], entry["KW"], entry["FT"], entry["SQ"], entry["SEQ"])
-      conn.execute("INSERT INTO db VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", entry_tuple)
-      if (i % 10000) == 0:
-        cur_time = time.time()
-        time_taken = cur_time - prev_time
-        IPS = (i - prev_i) / time_taken
-        self.c.commit()
-        print "Current entry: " + str(i) + " (" + str(int(IPS)) + " inserts per second)"
-        prev_i = i
-        prev_time = cur_time
-    conn.execute("CREATE INDEX pk ON db (ID)")
+
+  def create_tables(self):
+    if(self.schema == "wide"):
+      self.c.execute("CREATE TABLE db (" + ", ".join(field + " text" for field in FIELDS) + ")")
+    else:
+      self.c.execute("CREATE TABLE annotation (" + ", ".join(field + " text" for field in SLIM_FIELDS) + ")")
+      self.c.execute("CREATE TABLE bulk (ID text, data blob)")
+
+  def create_lookup_tables(self):
+    self.c.execute("CREATE TABLE accession (KEY text, ID text)")
+    self.c.execute("CREATE TABLE xref (DB text, XID text, ID text)")
+
+  def index_lookups(self):
+    self.c.execute("CREATE INDEX accession_key ON accession (KEY)")
+    self.c.execute("CREATE INDEX accession_id ON accession (ID)")
+    self.c.execute("CREATE INDEX xref_key ON xref (DB, XID)")
+    self.c.execute("CREATE INDEX xref_id ON xref (ID)")
+
+  def create_indexes(self):
+    if(self.schema == "wide"):
+      self.c.execute("CREATE INDEX pk ON db (ID)")
+      self.c.execute("CREATE INDEX ac ON db (AC)")
+    else:
+      self.c.execute("CREATE INDEX annotation_pk ON annotation (ID)")
+      self.c.execute("CREATE INDEX annotation_ac ON annotation (AC)")
+      self.c.execute("CREATE INDEX bulk_pk ON bulk (ID)")
+
+  def insert_rows(self, rows):
+    self.insert_entries(rows)
+    self.insert_lookups([lookup_fields(row) for row in rows])
+
+  def insert_lookups(self, entries):
+    self.c.executemany("INSERT INTO accession VALUES (?,?)", (key for id, ac, dr in entries for key in accession_rows(id, ac)))
+    self.c.executemany("INSERT INTO xref VALUES (?,?,?)", (xref for id, ac, dr in entries for xref in xref_rows(id, dr)))
+
+  def insert_entries(self, rows):
+    if(self.schema == "wide"):
+      self.c.executemany("INSERT INTO db VALUES (" + ",".join("?" * len(FIELDS)) + ")", rows)
+    else:
+      self.c.executemany("INSERT INTO annotation VALUES (" + ",".join("?" * len(SLIM_FIELDS)) + ")", (slim_row(row) for row in rows))
+      self.c.executemany("INSERT INTO bulk VALUES (?,?)", (bulk_row(row) for row in rows))
+
+  def delete_entry(self, seq_id):
+    self.c.execute("DELETE FROM accession WHERE ID=?", (seq_id,))
+    self.c.execute("DELETE FROM xref WHERE ID=?", (seq_id,))
+    if(self.schema == "wide"):
+      self.c.execute("DELETE FROM db WHERE ID=?", (seq_id,))
+    else:
+      self.c.execute("DELETE FROM annotation WHERE ID=?", (seq_id,))
+      self.c.execute("DELETE FROM bulk WHERE ID=?", (seq_id,))
+
+  def open_db(self):
+    self.c.execute("PRAGMA synchronous = OFF")
+    self.c.execute("PRAGMA journal_mode = MEMORY")
+    self.schema = db_schema(self.c)
+    self.c.execute("CREATE TABLE IF NOT EXISTS meta (key text PRIMARY KEY, value text)")
+    if(not self.c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='hashes'").fetchone()):
+      # Databases created before entries were hashed
+      print("Hashing existing entries")
+      self.c.execute("CREATE TABLE hashes (NAME text, ID text, AC text, HASH text)")
+      rows = self.c.execute("SELECT " + ", ".join(FIELDS) + " FROM db WHERE ID != ''")
+      self.c.executemany("INSERT INTO hashes VALUES (?,?,?,?)", (hash_row(row) for row in rows))
+      self.index_hashes()
+    if(not self.c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='accession'").fetchone()):
+      # Databases created before accessions and cross-references were indexed
+      print("Indexing accessions and cross-references")
+      self.create_lookup_tables()
+      table = "db" if self.schema == "wide" else "annotation"
+      rows = self.c.cursor().execute("SELECT ID, AC, DR FROM " + table + " WHERE ID != ''")
+      while True:
+        batch = rows.fetchmany(REPORT_EVERY)
+        if(not batch):
+          break
+        self.insert_lookups(batch)
+      self.index_lookups()
+    self.c.commit()
+
+  def index_hashes(self):
+    self.c.execute("CREATE UNIQUE INDEX hashes_name ON hashes (NAME)")
+    self.c.execute("CREATE INDEX hashes_ac ON hashes (AC)")
+
+  def set_release(self, release):
+    self.c.execute("INSERT OR REPLACE INTO meta VALUES ('release', ?)", (release,))
+    self.c.execute("INSERT OR REPLACE INTO meta VALUES ('updated', ?)", (time.strftime("%Y-%m-%d %H:%M:%S"),))
+
+  def parse(self, workers, chunk_bytes):
+    """Yields the rows of byte ranges of the UniProt file, parsed in a process pool if workers > 1."""
+    ranges = split_file(self.filename, chunk_bytes)
+    if(workers > 1):
+      pool = multiprocessing.Pool(workers)
+      try:
+        for rows in pool.imap_unordered(parse_range, ranges):
+          yield rows
+      finally:
+        pool.terminate()
+    else:
+      for task in ranges:
+        yield parse_range(task)
+
+  def populate_db(self, workers=1, chunk_bytes=CHUNK_BYTES, release=None):
+    """Bulk inserts the parsed rows. The indexes are built once all rows are in."""
+    progress = Progress()
+    for rows in self.parse(workers, chunk_bytes):
+      self.insert_rows(rows)
+      self.c.executemany("INSERT INTO hashes VALUES (?,?,?,?)", (hash_row(row) for row in rows))
+      self.c.commit()
+      progress.add(len(rows))
+    progress.done()
+    print("Building indexes")
+    self.create_indexes()
+    self.index_lookups()
+    self.index_hashes()
+    self.set_release(release or os.path.basename(self.filename))
+    self.c.commit()
+    print("DONE")
+
+  def update_db(self, workers=1, chunk_bytes=CHUNK_BYTES, release=None, delta=False, deleted=None):
+    """Upserts the entries whose content hash changed.
+
+    A full release also deletes the entries it no longer contains. A delta
+    file only holds new and changed entries, retired accessions can then be
+    given as a file with one accession per line."""
+    progress = Progress()
+    counts = defaultdict(int)
+    if(not delta):
+      self.c.execute("CREATE TEMP TABLE seen (NAME text PRIMARY KEY)")
+    for rows in self.parse(workers, chunk_bytes):
+      hashed = [hash_row(row) for row in rows]
+      known = dict()
+      for names in chunks([h[0] for h in hashed]):
+        for name, id, digest in self.c.execute("SELECT NAME, ID, HASH FROM hashes WHERE NAME IN (" + ",".join("?" * len(names)) + ")", names):
+          known[name] = (id, digest)
+      for row, h in zip(rows, hashed):
+        name = h[0]
+        if(name not in known):
+          counts["inserted"] += 1
+        elif(known[name][1] != h[3]):
+          self.delete_entry(known[name][0])
+          counts["updated"] += 1
+        else:
+          counts["unchanged"] += 1
+          continue
+        self.insert_rows([row])
+        self.c.execute("INSERT OR REPLACE INTO hashes VALUES (?,?,?,?)", h)
+      if(not delta):
+        self.c.executemany("INSERT OR IGNORE INTO seen VALUES (?)", ((h[0],) for h in hashed))
+      self.c.commit()
+      progress.add(len(rows))
+    progress.done()
+    if(not delta):
+      retired = self.c.execute("SELECT NAME, ID FROM hashes WHERE NAME NOT IN (SELECT NAME FROM seen)").fetchall()
+      self.delete(retired, counts)
+    if(deleted):
+      accessions = [line.strip() for line in open(deleted) if line.strip()]
+      for acs in chunks(accessions):
+        self.delete(self.c.execute("SELECT NAME, ID FROM hashes WHERE AC IN (" + ",".join("?" * len(acs)) + ")", acs).fetchall(), counts)
+    self.set_release(release or os.path.basename(self.filename))
+    self.c.commit()
+    print(", ".join(str(counts[key]) + " " + key for key in ("inserted", "updated", "unchanged", "deleted")))
+
+  def delete(self, entries, counts):
+    for name, id in entries:
+      self.delete_entry(id)
+      self.c.execute("DELETE FROM hashes WHERE NAME=?", (name,))
+      counts["deleted"] += 1
+
+  def migrate(self):
+    """Moves the entries of a wide database into the slim schema."""
+    if(self.schema == "slim"):
+      print("Already slim")
+      return
+    self.schema = "slim"
+    self.create_tables()
+    progress = Progress()
+    rows = self.c.cursor().execute("SELECT " + ", ".join(FIELDS) + " FROM db WHERE ID != ''")
+    while True:
+      batch = rows.fetchmany(REPORT_EVERY)
+      if(not batch):
+        break
+      self.insert_entries(batch)
+      progress.add(len(batch))
+    progress.done()
+    print("Building indexes")
+    self.create_indexes()
+    self.c.execute("DROP TABLE db")
     self.c.commit()
+    print("Compacting")
+    self.c.execute("VACUUM")
+    print("DONE")
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description="Create SQLite DBs from UniProt databases")
 
   parser.add_argument("-f", "--file", dest="filename", help="Input file (database)")
   parser.add_argument("-o", "--output", dest="output", help="Output filename", default="db/db")
+  parser.add_argument("-w", "--workers", dest="workers", type=int, help="Processes parsing the input file", default=1)
+  parser.add_argument("--chunk-bytes", dest="chunk_bytes", type=int, help="Bytes of the input file parsed per task", default=CHUNK_BYTES)
+  parser.add_argument("-r", "--release", dest="release", help="UniProt release recorded in the database (default: input filename)")
+  parser.add_argument("-u", "--update", dest="update", action="store_true", help="Update an existing database with a new release, rewriting only changed entries")
+  parser.add_argument("--delta", dest="delta", action="store_true", help="With --update, the input only holds new and changed entries")
+  parser.add_argument("--deleted", dest="deleted", help="With --update, a file of retired accessions to delete")
+  parser.add_argument("--schema", dest="schema", choices=SCHEMAS, help="Store every field in one table, or the annotation fields apart from the compressed rest", default="wide")
+  parser.add_argument("--migrate", dest="migrate", action="store_true", help="Convert the existing wide database given by -o to the slim schema")
 
   args = parser.parse_args()
 
-  uf = UniProtFile(args.filename)
-
-  db = DB(args.filename, args.output)
-  db.populate_db()
+  db = DB(args.filename, args.output, args.update or args.migrate, args.schema)
+  if(args.migrate):
+    db.migrate()
+  elif(args.update):
+    db.update_db(args.workers, args.chunk_bytes, args.release, args.delta, args.deleted)
+  else:
+    db.populate_db(args.workers, args.chunk_bytes, args.release)
@@ -0,0 +1,120 @@
+import mmap
+import os
+
+class FaiEntry(object):
+  """One line of a samtools .fai index."""
+  __slots__ = ("name", "length", "offset", "line_bases", "line_width")
+
+  def __init__(self, name, length, offset, line_bases, line_width):
+    self.name = name
+    self.length = length
+    self.offset = offset
+    self.line_bases = line_bases
+    self.line_width = line_width
+
+  def to_line(self):
+    return "\t".join((self.name, str(self.length), str(self.offset), str(self.line_bases), str(self.line_width))) + "\n"
+
+def build_fai(filename):
+  """Scans a FASTA file and returns its index entries in file order.
+
+  Like samtools faidx, every line of a sequence except the last must have
+  the same length, otherwise positions can not be turned into offsets. A
+  blank line counts as a short line, so it may only end a sequence."""
+  entries = list()
+  entry = None
+  short_line = False
+  offset = 0
+  with open(filename, "rb") as f:
+    for line in f:
+      offset += len(line)
+      if(line.startswith(">")):
+        entry = FaiEntry((line[1:].split() or [""])[0], 0, offset, 0, 0)
+        entries.append(entry)
+        short_line = False
+        continue
+      bases = len(line.rstrip("\r\n"))
+      if(entry == None):
+        continue
+      if(bases == 0):
+        short_line = True
+        continue
+      if(short_line):
+        raise ValueError("Different line length in sequence " + entry.name + " of " + filename)
+      if(entry.line_bases == 0):
+        entry.line_bases = bases
+        entry.line_width = len(line)
+      # Only the last line of the file can lack its line break
+      elif(bases > entry.line_bases or (bases == entry.line_bases and line.endswith("\n") and len(line) != entry.line_width)):
+        raise ValueError("Different line length in sequence " + entry.name + " of " + filename)
+      short_line = bases < entry.line_bases
+      entry.length += bases
+  return entries
+
+class FastaIndex:
+  """Random access to the sequences of a FASTA file through a samtools-style .fai index.
+
+  The index is written next to the FASTA file the first time and reused as
+  long as it is newer than the file. Subsequences are read from a memory
+  map of the file, so whole sequences are never loaded to serve a slice."""
+  def __init__(self, filename, fai=None):
+    self.filename = filename
+    self.fai = fai or filename + ".fai"
+    self.entries = dict()
+    self.names = list()
+    for entry in self.load():
+      self.entries[entry.name] = entry
+      self.names.append(entry.name)
+    self.f = open(filename, "rb")
+    if(os.path.getsize(filename) > 0):
+      self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+      self.data = ""
+
+  def load(self):
+    if(os.path.exists(self.fai) and os.path.getmtime(self.fai) >= os.path.getmtime(self.filename)):
+      entries = list()
+      for line in open(self.fai):
+        name, length, offset, line_bases, line_width = line.rstrip("\n").split("\t")[:5]
+        entries.append(FaiEntry(name, int(length), int(offset), int(line_bases), int(line_width)))
+      return entries
+    entries = build_fai(self.filename)
+    try:
+      with open(self.fai, "w") as f:
+        for entry in entries:
+          f.write(entry.to_line())
+    except IOError:
+      # A read-only directory only costs us the rebuild next time
+      pass
+    return entries
+
+  def __contains__(self, name):
+    return name in self.entries
+
+  def __iter__(self):
+    return iter(self.names)
+
+  def __len__(self):
+    return len(self.names)
+
+  def length(self, name):
+    return self.entries[name].length
+
+  def position(self, entry, pos):
+    return entry.offset + (pos // entry.line_bases) * entry.line_width + pos % entry.line_bases
+
+  def fetch(self, name, start=0, end=None):
+    """Returns bases start to end (0-based, end exclusive) of a sequence, without line breaks."""
+    entry = self.entries[name]
+    if(end == None or end > entry.length):
+      end = entry.length
+    start = max(start, 0)
+    if(start >= end):
+      return ""
+    raw = self.data[self.position(entry, start):self.position(entry, end - 1) + 1]
+    return raw.replace("\n", "").replace("\r", "")
+
+  def close(self):
+    if(self.data != ""):
+      self.data.close()
+    self.f.close()
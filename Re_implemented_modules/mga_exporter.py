@@ -1,28 +1,67 @@
 import argparse
+import os
+import string
+import sys
+import time
 
-class ContigFile:
+from fasta_index import FastaIndex
+
+BUFFER_SIZE = 1024 * 1024
+
+COMPLEMENT = string.maketrans("ACGTUNRYKMSWBDHVacgtunrykmswbdhv", "TGCAANYRMKSWVHDBtgcaanyrmkswvhdb")
+
+# The standard genetic code, codons ordered by bases TCAG
+BASES = "TCAG"
+AMINO_ACIDS = "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+CODONS = dict((a + b + c, AMINO_ACIDS[16 * i + 4 * j + k])
+              for i, a in enumerate(BASES) for j, b in enumerate(BASES) for k, c in enumerate(BASES))
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def translate(seq):
+    seq = seq.upper()
+    return "".join([CODONS.get(seq[i:i + 3], "X") for i in range(0, len(seq) - 2, 3)])
+
+
+class MgaGenes:
+    """Streams the genes of an MGA output file as (contig, gene, start, end, strand, frame).
+
+    Every sequence starts with a "# <name>" line followed by "# gc = ..." and
+    "# self: ..." lines. Coordinates are 1-based and inclusive, frame is the
+    number of bases before the first complete codon of a partial gene."""
     def __init__(self, path):
-       self.f = open(path)
-       self.contigs = dict()
+        self.path = path
 
-    def read(self):
-        while True:
-          line = self.f.readline()
-          if line.startswith(">"):
-              self.contigs[line[1:].strip()] = self.f.tell()
-          elif line == '':
-              return
+    def __iter__(self):
+        contigId = ""
+        for line in open(self.path):
+            if(line.startswith("#")):
+                header = line[1:].strip()
+                if(not header.startswith("gc =") and not header.startswith("self:")):
+                    contigId = header
+            elif(line.strip()):
+                splitLine = line.split("\t")
+                yield (contigId, splitLine[0], int(splitLine[1]), int(splitLine[2]), splitLine[3], int(splitLine[4]))
 
 
-    def get_contig(self, contig):
-        output = []
-        self.f.seek(self.contigs[contig])
-        while True:
-            line = self.f.readline()
-            if line.startswith(">") or line == '':
-                return "".join(output)
-            else:
-                output.append(line)
+class Extractor:
+    """Cuts the genes out of the contigs, reverse complementing genes on the minus strand."""
+    def __init__(self, contigs, protein=False):
+        self.contigs = contigs
+        self.protein = protein
+
+    def extract(self, contigId, start, end, strand, frame):
+        name = contigId.split()[0]
+        if(strand == "-"):
+            seq = reverse_complement(self.contigs.fetch(name, start - 1, end - frame))
+        else:
+            seq = self.contigs.fetch(name, start - 1 + frame, end)
+        if(self.protein):
+            return translate(seq)
+        return seq
 
 
 class Main:
@@ -30,24 +69,26 @@ class Main:
         parser = argparse.ArgumentParser(description="META-pipe MGA Exporter (MGA to fasta)")
         parser.add_argument("-i", "--input", dest="input", help="Contig file")
         parser.add_argument("-o", "--output", dest="output", help="MGA output")
+        parser.add_argument("-r", "--result", dest="result", help="FASTA file to write (default: standard output)")
+        parser.add_argument("-p", "--protein", dest="protein", action="store_true", help="Translate the genes to protein")
+        parser.add_argument("--buffer", dest="buffer", type=int, help="Output buffer size in bytes", default=BUFFER_SIZE)
         self.args = parser.parse_args()
-        self.contigs = ContigFile(self.args.input)
-        self.contigs.read()
+        self.contigs = FastaIndex(self.args.input)
 
     def run(self):
-        firstLine = True
-        contig = ""
-        contigId = ""
-        for line in open(self.args.output):
-            if(line.startswith("# contig")):
-                if(contigId != line[1:].strip()):
-                  contigId = line[1:].strip()
-                  contig = self.contigs.get_contig(contigId)
-            elif(line.startswith("gene")):
-                splitLine = line.split("\t")
-#                print(splitLine)
-                print(">" + contigId + "_" + splitLine[0])
-                print(contig[int(splitLine[1]):int(splitLine[2])])
+        extractor = Extractor(self.contigs, self.args.protein)
+        if(self.args.result):
+            out = open(self.args.result, "w", self.args.buffer)
+        else:
+            out = os.fdopen(os.dup(sys.stdout.fileno()), "w", self.args.buffer)
+        genes = 0
+        start_time = time.time()
+        for contigId, gene, start, end, strand, frame in MgaGenes(self.args.output):
+            out.write(">" + contigId + "_" + gene + "\n" + extractor.extract(contigId, start, end, strand, frame) + "\n")
+            genes += 1
+        out.close()
+        time_taken = time.time() - start_time
+        sys.stderr.write("Extracted " + str(genes) + " genes in " + "%.2f" % time_taken + " seconds (" + str(int(genes / max(time_taken, 1e-9))) + " genes per second)\n")
 
 
 if __name__ == "__main__":